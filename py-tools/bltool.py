@@ -46,10 +46,33 @@ Optimize does the following:
    and stores them in cache files. This cache has a default "life time" of one
    day, which can be changed with the --shopcache_timeout option.
 
-2. Runs the optimizer. There are two optimizers:
+2. Simplifies the model (unless --nopresolve): shops that are the only
+   source of a part are always taken, shops that another shop beats on
+   every part are dropped and parts with identical offers are merged.
+   Every reduction is printed.
+
+3. Runs the optimizer. There are these optimizers:
    --mode=builtin (default)
      Considers the 20 best shops, takes about a minute. The runtime is
      exponential, so adding 1 shop will roughly double how long it takes.
+     --evaluator=numpy scores many combinations at once and is a lot faster
+     if the numpy module is installed. --frontier also keeps the cheapest
+     orders for each number of shops during the same search, so one run
+     shows how much every additional shop saves.
+   --mode=bnb
+     Branch and bound search. Skips all combinations that provably cannot be
+     cheaper than the best one found so far, so it can consider 40-60 shops
+     in a reasonable time. The processes of --jobs share the best price found.
+   --mode=mitm
+     Meet in the middle: splits the shops into two halves, enumerates the
+     subsets of each half on their own and combines them cheapest bound
+     first. It is exact and handles up to about 36 shops, and is often
+     faster than bnb when many shops offer the same parts at similar prices.
+   --mode=heuristic
+     Local search that opens and closes one shop at a time, for
+     --time_budget seconds (30 by default). It handles hundreds of shops,
+     e.g. --consider_shops=500, and prints every better price it finds, but
+     it can't tell whether the result is optimal.
    --mode=glpk
      Use the external GLPK optimizer (http://www.gnu.org/software/glpk/). For
      this, 'glpsol' must be in the path. Runtime is typically longer, but it
@@ -57,18 +80,60 @@ Optimize does the following:
      --condiser_shops=40 should be fast, 100 is also feasible but may take
      hours to complete. This mode caches the solution so if the pricing info,
      the model and the relevant arguments don't change then it will reuse the
-     previous solution.
-     
-3. Prints the result.
+     previous solution. With --warm_start_seconds, it first runs the local
+     search of --mode=heuristic, prints its result right away and lets glpk
+     only look for cheaper solutions.
+   --mode=highs
+     Solves the same model as glpk with the highs program of HiGHS, which
+     has to be in the PATH. It is usually a lot faster than glpsol and uses
+     --jobs threads. Its model and solution files are written to --cachedir
+     but not reused. --glpk_limit_seconds limits its time as well, and
+     --warm_start_seconds gives it a first solution to start from.
+   --mode=portfolio
+     Runs the variants of --portfolio, e.g. "bnb,heuristic,glpk:jobs=2", in
+     parallel. They share the best price found. The first variant that
+     proves its result optimal wins, or the best result after --time_budget
+     seconds. The winners are recorded in portfolio.history in --cachedir.
+   --mode=auto
+     Times short trials of the variants of --auto_variants on more and more
+     shops and runs the one that can consider the most shops within
+     --time_budget seconds, with that --consider_shops. The builtin
+     searches are timed on a sample of their combinations, the others are
+     stopped when a trial takes too long and extrapolated. If none can
+     consider enough shops, it runs --mode=heuristic on all shops. It prints
+     what it timed and what it chose.
+   Ctrl+C stops the search and prints the best orders found so far. The
+   builtin, bnb and mitm searches save their progress to --cachedir every
+   minute and on Ctrl+C, and --resume continues from there.
+
+4. Prints the result.
    By default, it prints a short summary of which shops were considered,
-   selected and which brick should be ordered from which shop.
+   selected and which brick should be ordered from which shop, and how far
+   its cost may at most be from the optimum: "cost X, lower bound Y, gap Z%".
+   With --target_gap=0.01 every mode stops as soon as the gap is below 1%.
+   With --frontier it also prints the cheapest orders for each number of
+   shops that is cheaper than all fewer shops, and with
+   --shop_fix_cost_sweep=0:5:0.5 the cheapest orders for each of these
+   shop fix costs, found in the same search. --alternatives=10 prints the
+   next 10 cheapest combinations of shops (builtin and bnb), so if a shop
+   of the orders is on vacation, the best orders without it are usually
+   among them and need no new run with --exclude_shops.
    --output_html=<filename>
      If set, writes all details into a HTML file. The file contains:
      * list of all shops considered, with scores
+     * the cheapest orders for each number of shops, with --frontier
+     * the cheapest orders for each fix cost, as a table and a chart, with
+       --shop_fix_cost_sweep
+     * the alternative orders, with --alternatives
      * list of all shops to order from
      * list of all bricks to order from each shop
      * BrickLink wanted list XML list for each shop
 
+The 'scenarios' command compares flag sets for the same model, e.g. some
+--include_countries, --exclude_shops or --shop_fix_cost variants. It reads
+the parts and the shop data only once and optimizes the scenarios of the
+file in --jobs processes at a time, then prints their cost side by side.
+
 Caveats:
 * Part identifiers have the form NNNN-MM where NNNN is the BrickLink
   part ID and MM is the color code (as on BLID on http://peeron.com/inv/colors).
@@ -78,17 +143,29 @@ Caveats:
   based on your IP address.
 * The shipping costs are modeled as a fix cost per shop. The cost can be
   controlled by the --shop_fix_cost flag.
-* The minimum purchase per shop is only taken into account
-  with --model=glpk.
+* The minimum purchase per shop is met exactly by glpk and highs. The
+  builtin, bnb, mitm and heuristic modes fill up a shop that falls short
+  of it or leave it out, whichever a greedy repair finds cheaper, so their
+  orders meet it but may not be the cheapest ones that do, and they don't
+  claim to be optimal. Shops that can't reach their minimum at all are
+  left out before the search.
+* If no lot of a shop has all of the needed items of a part, its biggest
+  lot is used and the rest of the part comes from other shops. Only one lot
+  of each part is used per shop. --nopartial_lots only uses lots that have
+  all the needed items.
 * Some shops allow items to be purchased in batches only. This is not
   taken into account. To work around, you can order more or use
   --exclude_shops.
-* When --model=glpk, the ordered quantity may be more than the needed one,
-  to fulfill mininum order requirements of shops.
+* The ordered quantity may be more than the needed one, to fulfill
+  mininum order requirements of shops.
 """
 
+import multiprocessing
 import os.path
+import re
+import shlex
 import sys
+import time
 
 import fetch_shops
 import fetch_wanted_list
@@ -156,8 +233,26 @@ COMMANDS = {
           'output_html', 'cachedir', 'shopcache_timeout', 'include_used',
           'exclude_used', 'mode', 'rerun_solver', 'multiple', 'exclude_shops',
           'include_shops', 'include_countries', 'exclude_countries',
-          'shop_fix_cost', 'max_shops', 'consider-shops', 'glpk_limit_seconds'],
-      'func': lambda argv: OptimizeCommand(argv)}
+          'shop_fix_cost', 'max_shops', 'consider-shops', 'glpk_limit_seconds',
+          'evaluator', 'partial_lots', 'presolve', 'decompose', 'time_budget',
+          'target_gap', 'portfolio', 'auto_variants', 'warm_start_seconds',
+          'resume',
+          'frontier', 'alternatives', 'shop_fix_cost_sweep'],
+      'func': lambda argv: OptimizeCommand(argv)},
+  'scenarios': {
+      'usage': '[<flags>] scenarios <scenario_file> <LDD_file>',
+      'desc': 'Optimizes the same model with each of the named flag sets in '
+              'the scenario file and prints a comparison. Each line of the '
+              'file is a name followed by optimize flags, e.g.\n'
+              '    germany --include_countries=Germany --shop_fix_cost=3\n'
+              '  The parts and shops are read once, then --jobs scenarios at '
+              'a time run in processes of their own, with one process each, '
+              'and write their output to a log file in --cachedir. '
+              '--output_html writes the comparison, a scenario can set its '
+              'own.',
+      'flags': ['output_html', 'cachedir', 'shopcache_timeout', 'inventory',
+                'jobs'],
+      'func': lambda argv: ScenariosCommand(argv)}
 }
 
 def ReportError(msg):
@@ -202,38 +297,47 @@ def ListCommand(argv):
   else:
     ReportError('Not enough args for list.')
     
+def ReadPartsAndShops(args):
+  """Reads the parts of LDD files or the special values and their shops."""
+  if args[0] == 'wlist':
+    parts = fetch_wanted_list.FetchListParts()
+  # This arguably isn't the most useful option, but it works and in theory it
+  # gives you what your own inventory would be worth if bought now on BL
+  elif args[0] == 'store':
+    parts = fetch_inventory.FetchStoreInfo()
+  else:
+    parts = ReadParts(args)
+  try:
+    os.makedirs(FLAGS.cachedir)
+  except OSError:
+    pass
+  # reduce wanted parts by parts indicated to be already present
+  if (FLAGS.inventory):
+    iparts = ReadParts(FLAGS.inventory)
+    collector = part_collector.PartCollector()
+    collector.InitParts(parts)
+    parts = collector.Subtract(iparts)
+  return (parts, fetch_shops.FetchShopInfo(parts))
+
 def OptimizeCommand(argv):
   if len(argv) >= 3:
-    if argv[2] == 'wlist':
-      parts = fetch_wanted_list.FetchListParts()
-    # This arguably isn't the most useful option, but it works and in theory it
-    # gives you what your own inventory would be worth if bought now on BL
-    elif argv[2] == 'store':
-      parts = fetch_inventory.FetchStoreInfo()
-    else:
-      parts = ReadParts(argv[2:])
-    try:
-      os.makedirs(FLAGS.cachedir)
-    except OSError:
-      pass
-    # reduce wanted parts by parts indicated to be already present
-    if (FLAGS.inventory):
-      iparts = ReadParts(FLAGS.inventory)
-      collector = part_collector.PartCollector()
-      collector.InitParts(parts)
-      parts = collector.Subtract(iparts)
-    shop_data = fetch_shops.FetchShopInfo(parts)
+    parts, shop_data = ReadPartsAndShops(argv[2:])
       
+    allow_used = AllowedUsedBricks(parts)
     try:
       opt = optimizer.CreateOptimizer()
+      opt.Load(parts, argv[2], shop_data, allow_used)
     except NameError, e:
       ReportError(e)
-
-    allow_used = AllowedUsedBricks(parts)
-    opt.Load(parts, argv[2], shop_data, allow_used)
     output.PrintShopsText(opt)
-    opt.Run()
+    try:
+      opt.Run()
+    except KeyboardInterrupt:
+      print 'Interrupted, these are the best orders found so far.'
     output.PrintOrdersText(opt, FLAGS.shop_fix_cost)
+    output.PrintFrontierText(opt)
+    output.PrintSweepText(opt)
+    output.PrintAlternativesText(opt)
     
     if FLAGS.output_html:
       output.PrintAllHtml(
@@ -242,6 +346,141 @@ def OptimizeCommand(argv):
   else:
     ReportError('Optimize needs exactly one argument.')
 
+def ReadScenarios(file_name):
+  """
+  Reads a scenario file into a list of (name, [(flag, value)]). Each line is
+  a name and optimize flags, blank lines and lines starting with # are
+  skipped.
+  """
+  scenarios = []
+  scenario_file = open(file_name, 'r')
+  try:
+    lines = scenario_file.readlines()
+  finally:
+    scenario_file.close()
+  for line in lines:
+    fields = shlex.split(line, comments=True)
+    if not fields:
+      continue
+    name = fields[0]
+    if name in [n for n, overrides in scenarios]:
+      ReportError('Scenario %s is defined twice.' % name)
+    overrides = []
+    for field in fields[1:]:
+      if not field.startswith('--'):
+        ReportError('Expected --flag=value in scenario %s, not %s' % (
+            name, field))
+      flag, value = (field[2:].split('=', 1) + [None])[:2]
+      if value is None and flag not in FLAGS.FlagDict():
+        # --noflag for a boolean flag
+        if flag.startswith('no') and flag[2:] in FLAGS.FlagDict():
+          flag, value = flag[2:], 'false'
+      if flag not in FLAGS.FlagDict():
+        ReportError('Unknown flag --%s in scenario %s' % (flag, name))
+      if value is None:
+        if not FLAGS[flag].boolean:
+          ReportError('Flag --%s needs a value in scenario %s' % (flag, name))
+        value = 'true'
+      overrides.append((flag, value))
+    # its processes can't start processes of their own
+    for mode in ('portfolio', 'auto'):
+      if ('mode', mode) in overrides:
+        ReportError('Scenario %s can\'t use --mode=%s.' % (name, mode))
+    scenarios.append((name, overrides))
+  return scenarios
+
+# (parts, LDD file name, shop data, scenarios) of the scenarios command. The
+# processes that run the scenarios inherit them when they start, instead of
+# reading them again.
+_scenarios = None
+
+def ScenarioLogFileName(ldd_file_name, name):
+  return '%s/%s.%s.log' % (
+      FLAGS.cachedir, os.path.splitext(os.path.basename(ldd_file_name))[0],
+      re.sub(r'[^\w.<>-]', '_', name))
+
+def RunScenario(k):
+  """
+  Runs scenario k in a process of its own, which ends afterwards, so its
+  flags don't affect the other scenarios. Writes its output to a log file
+  and returns a dict of its results.
+  """
+  parts, ldd_file_name, shop_data, scenarios = _scenarios
+  name, overrides = scenarios[k]
+  log_file_name = ScenarioLogFileName(ldd_file_name, name)
+  result = {'index': k, 'name': name,
+            'flags': ' '.join('--%s=%s' % o for o in overrides)}
+  start = time.time()
+  sys.stdout = open(log_file_name, 'w')
+  try:
+    FLAGS.output_html = ''
+    for flag, value in overrides:
+      FLAGS[flag].Parse(value)
+    FLAGS.jobs = 1
+    opt = optimizer.CreateOptimizer()
+    opt.Load(parts, ldd_file_name, shop_data, AllowedUsedBricks(parts))
+    output.PrintShopsText(opt)
+    opt.Run()
+    output.PrintOrdersText(opt, FLAGS.shop_fix_cost)
+    if FLAGS.output_html:
+      output.PrintAllHtml(
+          opt, shop_data, FLAGS.shop_fix_cost, ldd_file_name,
+          FLAGS.output_html)
+    orders = opt.Orders()
+    if orders is None:
+      result['error'] = 'No possible orders.'
+    else:
+      result.update({
+          'gross': opt.GrossGrandTotal(), 'net': opt.NetGrandTotal(),
+          'shops': sorted(orders), 'bound': opt.LowerBound(),
+          'gap': opt.Gap()})
+  except Exception, e:
+    result['error'] = str(e)
+  except SystemExit, e:
+    # the pool would wait forever for the result of this scenario
+    result['error'] = 'Exited with status %s.' % e.code
+  finally:
+    sys.stdout.close()
+    sys.stdout = sys.__stdout__
+  result['seconds'] = time.time() - start
+  return result
+
+def ScenariosCommand(argv):
+  global _scenarios
+  if len(argv) < 4:
+    ReportError('Scenarios needs a scenario file and the model.')
+  scenarios = ReadScenarios(argv[2])
+  parts, shop_data = ReadPartsAndShops(argv[3:])
+  _scenarios = (parts, argv[3], shop_data, scenarios)
+
+  print 'Running %d scenarios in %d processes.' % (len(scenarios), FLAGS.jobs)
+  results = [None] * len(scenarios)
+  # a new process for each scenario, started from this one with the data
+  pool = multiprocessing.Pool(processes=FLAGS.jobs, maxtasksperchild=1)
+  finished = pool.imap_unordered(RunScenario, xrange(len(scenarios)))
+  try:
+    for k in xrange(len(scenarios)):
+      result = finished.next(0xFFFFFFFF)
+      results[result['index']] = result
+      if 'error' in result:
+        print 'Scenario %s: %s' % (result['name'], result['error'])
+      else:
+        print 'Scenario %s: %.2f from %d shops in %.1f seconds.' % (
+            result['name'], result['gross'], len(result['shops']),
+            result['seconds'])
+  except KeyboardInterrupt:
+    pool.terminate()
+    print 'Interrupted, comparing the finished scenarios.'
+  else:
+    pool.close()
+    pool.join()
+  results = [r for r in results if r is not None]
+  output.PrintScenariosText(results)
+  print 'The output of each scenario is in %s.' % ScenarioLogFileName(
+      argv[3], '<name>')
+  if FLAGS.output_html:
+    output.PrintScenariosHtml(results, argv[3], FLAGS.output_html)
+
 def ReadParts(filenames):
   collector = part_collector.PartCollector()
   for filename in filenames:
@@ -0,0 +1,288 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Local search for a cheap shop combination when there are far too many
+shops to try them all.
+"""
+
+import random
+import time
+
+# Prices are kept as integers of this many units per currency unit, so that
+# updating the sums incrementally does not accumulate rounding errors.
+PRICE_SCALE = 100000
+
+class _State(object):
+  """
+  A set of open shops, each part bought from the cheapest open one. Parts
+  that some shop has too few of are bought from the cheapest open lots
+  instead, each missing item costing more than any solution.
+
+  For every shop it keeps how much the total cost changes by opening or
+  closing it. Opening or closing a shop only changes the parts it offers,
+  so only their share of these deltas is updated.
+  """
+
+  def __init__(self, index, fix_cost):
+    num_parts = index.NumParts()
+    num_shops = index.NumShops()
+    self._index = index
+    self.fix = int(round(fix_cost * PRICE_SCALE))
+    # [[(int(shop), int(scaled price of the needed quantity))]] cheapest first
+    self._offers = [
+        [(j, int(round(price * index.demand[i] * PRICE_SCALE)))
+         for j, price in index.part_offers[i]]
+        for i in xrange(num_parts)]
+    # A part that no open shop offers costs more than any solution.
+    self._missing = 1 + self.fix * num_shops + sum(
+        offers[-1][1] for offers in self._offers if offers)
+    # [[(int(shop), float(unit price), int(quantity))]] of the parts that
+    # some shop has too few of, None for the others
+    self._lots = [None] * num_parts
+    for i in xrange(num_parts):
+      if index.partial_parts & 1 << i:
+        self._lots[i] = [(j, price, index.Quantity(i, j))
+                         for j, price in index.part_offers[i]]
+    # [(int(shop), int(delta))] each partial part added to _gain or _loss
+    self._deltas = [None] * num_parts
+    self.open = [False] * num_shops
+    self.mask = 0
+    self.count = 0
+    # cost of part i from the cheapest and second cheapest open shop
+    self._first = [self._missing] * num_parts
+    self._first_shop = [None] * num_parts
+    self._second = [self._missing] * num_parts
+    # saving by opening closed shop j
+    self._gain = [0] * num_shops
+    # extra cost by closing open shop j
+    self._loss = [0] * num_shops
+    self.cost = 0
+    for i in xrange(num_parts):
+      self._Add(i)
+      self.cost += self._first[i]
+
+  def _LotsCost(self, i, flip):
+    """Scaled cost of partial part i, with shop flip flipped if not None."""
+    needed = self._index.demand[i]
+    cost = 0.0
+    for j, price, quantity in self._lots[i]:
+      if self.open[j] != (j == flip):
+        quantity = min(needed, quantity)
+        cost += price * quantity
+        needed -= quantity
+        if not needed:
+          break
+    return int(round(cost * PRICE_SCALE)) + needed * self._missing
+
+  def _Add(self, i):
+    if self._lots[i] is not None:
+      self._AddLots(i)
+      return
+    first, first_shop, second = self._missing, None, self._missing
+    for j, c in self._offers[i]:
+      if self.open[j]:
+        if first_shop is None:
+          first, first_shop = c, j
+        else:
+          second = c
+          break
+    self._first[i] = first
+    self._first_shop[i] = first_shop
+    self._second[i] = second
+    for j, c in self._offers[i]:
+      if c >= first:
+        break
+      self._gain[j] += first - c
+    if first_shop is not None:
+      self._loss[first_shop] += second - first
+
+  def _AddLots(self, i):
+    first = self._LotsCost(i, None)
+    self._first[i] = first
+    self._deltas[i] = []
+    for j, price, quantity in self._lots[i]:
+      delta = self._LotsCost(i, j) - first
+      if self.open[j]:
+        self._loss[j] += delta
+        self._deltas[i].append((j, delta))
+      elif delta < 0:
+        self._gain[j] -= delta
+        self._deltas[i].append((j, delta))
+
+  def _Remove(self, i):
+    if self._lots[i] is not None:
+      for j, delta in self._deltas[i]:
+        if self.open[j]:
+          self._loss[j] -= delta
+        else:
+          self._gain[j] += delta
+      return
+    first = self._first[i]
+    for j, c in self._offers[i]:
+      if c >= first:
+        break
+      self._gain[j] -= first - c
+    if self._first_shop[i] is not None:
+      self._loss[self._first_shop[i]] -= self._second[i] - first
+
+  def Delta(self, j):
+    """Change of the total cost by opening or closing shop j."""
+    if self.open[j]:
+      return self._loss[j] - self.fix
+    return self.fix - self._gain[j]
+
+  def Flip(self, j):
+    """Opens shop j if it is closed, closes it otherwise."""
+    self.cost += self.Delta(j)
+    parts = [i for i, price in self._index.shop_offers[j]]
+    for i in parts:
+      self._Remove(i)
+    self.open[j] = not self.open[j]
+    self.mask ^= 1 << j
+    self.count += 1 if self.open[j] else -1
+    for i in parts:
+      self._Add(i)
+
+  def SetMask(self, mask):
+    for j in xrange(len(self.open)):
+      if bool(mask & 1 << j) != self.open[j]:
+        self.Flip(j)
+
+def _Cost(index, state, fix_cost):
+  """
+  Cost of the open shops of state in units of 1 / PRICE_SCALE, None if they
+  can't meet the minimum buy of a shop or don't have enough of a part.
+  state.cost ignores the minimum buy, which only adds to it.
+  """
+  if not state.mask & index.repair_mask:
+    return state.cost
+  price = index.TotalCost(state.mask, fix_cost)
+  if price is None:
+    return None
+  return int(round(price * PRICE_SCALE))
+
+def Search(index, fix_cost, deadline, seed=0, report=None, target=None):
+  """
+  Tabu search over opening and closing single shops, starting from a
+  greedy solution, until time.time() reaches deadline or a combination
+  costs at most target. The forced shops of the index stay open.
+  report(price, mask) is called for every improvement.
+
+  The moves ignore the minimum buy of the shops, the combinations that may
+  be the best are repaired with index.TotalCost().
+
+  Returns (price, mask) of the best combination found, (1.e10, None) if
+  there is none.
+  """
+  if not index.HasAllParts((1 << index.NumShops()) - 1):
+    return (1.e10, None)
+  rnd = random.Random(seed)
+  state = _State(index, fix_cost)
+  for j in xrange(index.NumFreeShops(), index.NumShops()):
+    state.Flip(j)
+  free = range(index.NumFreeShops())
+
+  # Greedy: open the shop that saves most as long as one saves anything,
+  # then close the shops that are no longer worth their fix cost.
+  while True:
+    closed = [j for j in free if not state.open[j]]
+    if not closed:
+      break
+    j = min(closed, key=state.Delta)
+    if state.Delta(j) >= 0:
+      break
+    state.Flip(j)
+  while True:
+    opened = [j for j in free if state.open[j]]
+    if not opened:
+      break
+    j = min(opened, key=state.Delta)
+    if state.Delta(j) >= 0:
+      break
+    state.Flip(j)
+
+  best_cost = _Cost(index, state, fix_cost)
+  best_mask = None
+  best_price = 1.e10
+  if best_cost is None:
+    best_cost = float('inf')
+  else:
+    best_mask = state.mask
+    best_price = index.TotalCost(best_mask, fix_cost)
+    if report:
+      report(best_price, best_mask)
+
+  # A shop that was just opened or closed may not be flipped back for a
+  # few iterations, unless that gives a new best solution. When nothing
+  # improves for a while, the search restarts from the best solution with
+  # a few random shops opened.
+  tenure = min(10, len(free) // 4 + 1)
+  stall = max(100, 5 * len(free))
+  tabu_until = [0] * len(free)
+  iteration = 0
+  last_improvement = 0
+  while free and (target is None or best_price > target):
+    iteration += 1
+    if not iteration & 0x3f and time.time() >= deadline:
+      break
+    move = None
+    move_delta = None
+    for j in free:
+      delta = state.Delta(j)
+      if (tabu_until[j] > iteration and state.cost + delta >= best_cost):
+        continue
+      if move is None or delta < move_delta:
+        move = j
+        move_delta = delta
+    if move is None:
+      continue
+    state.Flip(move)
+    tabu_until[move] = iteration + tenure + rnd.randint(0, tenure)
+    cost = None
+    if state.cost < best_cost:
+      cost = _Cost(index, state, fix_cost)
+    if cost is not None and cost < best_cost:
+      best_cost = cost
+      best_mask = state.mask
+      best_price = index.TotalCost(best_mask, fix_cost)
+      last_improvement = iteration
+      if report:
+        report(best_price, best_mask)
+    elif iteration - last_improvement > stall:
+      if best_mask is not None:
+        state.SetMask(best_mask)
+      closed = [j for j in free if not state.open[j]]
+      for j in rnd.sample(closed, min(len(closed),
+                                      rnd.randint(1, 3 + len(free) // 50))):
+        state.Flip(j)
+      last_improvement = iteration
+
+  return (best_price, best_mask)
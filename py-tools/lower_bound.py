@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Lower bounds of the cost of any order, to tell how far a solution that is
+not proven optimal may be from the optimum.
+
+The model is an uncapacitated facility location problem: every part is
+bought from exactly one open shop, each open shop costs the fix cost.
+Relaxing "every part from exactly one shop" with a multiplier v[i] per part
+gives the bound
+
+  sum(v[i]) + sum over shops j of min(0, fix + sum(min(0, c[i][j] - v[i])))
+
+for any v, c[i][j] being the price of the needed quantity of part i at
+shop j. The forced shops are always open, their term doesn't get the outer
+min(0, ...). Minimum buys are ignored, which only lowers the bound.
+"""
+
+import time
+
+# Longest time spent improving the bound by subgradient steps.
+MAX_SECONDS = 2.0
+
+# Subgradient steps without a better bound before the step size is halved.
+PATIENCE = 20
+
+class _Relaxation(object):
+  def __init__(self, index, fix_cost):
+    self._index = index
+    self._fix = fix_cost
+    # [[(int(shop), float(price of the needed quantity))]] cheapest first
+    self.offers = [
+        [(j, price * index.demand[i]) for j, price in index.part_offers[i]]
+        for i in xrange(index.NumParts())]
+    # [[(int(part), float(price of the needed quantity))]]
+    self.shop_offers = [
+        [(i, price * index.demand[i]) for i, price in index.shop_offers[j]]
+        for j in xrange(index.NumShops())]
+
+  def Evaluate(self, v):
+    """
+    Returns (bound, subgradient, mask of the shops open in the relaxation).
+    """
+    num_free = self._index.NumFreeShops()
+    bound = sum(v)
+    taken = [0] * len(v)
+    mask = 0
+    for j, offers in enumerate(self.shop_offers):
+      reduced = self._fix
+      for i, c in offers:
+        if c < v[i]:
+          reduced += c - v[i]
+      if reduced < 0 or j >= num_free:
+        bound += reduced
+        mask |= 1 << j
+        for i, c in offers:
+          if c < v[i]:
+            taken[i] += 1
+    return (bound, [1 - t for t in taken], mask)
+
+  def DualAscent(self):
+    """
+    Raises the multipliers part by part to the next price level of the
+    part, as long as no free shop gets a negative reduced cost (Erlenkotter's
+    dual ascent). Every v[i] stays at most the price at a forced shop.
+    """
+    num_free = self._index.NumFreeShops()
+    v = [offers[0][1] for offers in self.offers]
+    # fix cost minus what the multipliers already use of it, per free shop
+    slack = [self._fix] * num_free
+    # v[i] stays at most the cheapest price at a forced shop
+    cap = [min([c for j, c in offers if j >= num_free] or [float('inf')])
+           for offers in self.offers]
+    level = [1] * len(v)
+    active = sorted(xrange(len(v)), key=lambda i: len(self.offers[i]))
+    while active:
+      still_active = []
+      for i in active:
+        offers = self.offers[i]
+        target = cap[i]
+        if level[i] < len(offers):
+          target = min(target, offers[level[i]][1])
+        step = target - v[i]
+        reached = True
+        for j, c in offers:
+          if c > v[i]:
+            break
+          if j < num_free and slack[j] < step:
+            step = slack[j]
+            reached = False
+        if step <= 0:
+          continue
+        for j, c in offers:
+          if c > v[i]:
+            break
+          if j < num_free:
+            slack[j] -= step
+        if reached:
+          v[i] = target
+        else:
+          v[i] += step
+        if reached and target < cap[i]:
+          level[i] += 1
+          still_active.append(i)
+      active = still_active
+    return v
+
+def LowerBound(index, fix_cost, upper=None, seconds=MAX_SECONDS):
+  """
+  Returns a lower bound of the cost (with fix_cost for every shop) of any
+  combination of the shops of index that has all parts, None if there is
+  none. upper is the cost of a known solution, if any, to size the
+  subgradient steps. The minimum buy of the shops only adds to the cost,
+  the bound ignores it.
+  """
+  if not index.HasAllParts((1 << index.NumShops()) - 1):
+    return None
+  if index.NumParts() == 0:
+    return fix_cost * (index.NumShops() - index.NumFreeShops())
+  relaxation = _Relaxation(index, fix_cost)
+  v = relaxation.DualAscent()
+  bound, subgradient, mask = relaxation.Evaluate(v)
+  best = bound
+
+  # Polyak steps towards the cheapest solution known, which is either
+  # upper or the shops open in the relaxation plus the cheapest shop of
+  # every part they miss.
+  deadline = time.time() + seconds
+  scale = 1.0
+  since_better = 0
+  while time.time() < deadline and scale > 1e-4:
+    for i in xrange(len(v)):
+      if not index.part_shops[i] & mask:
+        mask |= 1 << index.part_offers[i][0][0]
+    cost = index.TotalCost(mask, fix_cost)
+    if cost is not None and (upper is None or cost < upper):
+      upper = cost
+    norm = sum(g * g for g in subgradient)
+    if norm == 0 or upper is None or upper - best <= 1e-9 * upper:
+      break
+    step = scale * (upper - bound) / norm
+    v = [v[i] + step * subgradient[i] for i in xrange(len(v))]
+    bound, subgradient, mask = relaxation.Evaluate(v)
+    if bound > best + 1e-9:
+      best = bound
+      since_better = 0
+    else:
+      since_better += 1
+      if since_better >= PATIENCE:
+        scale /= 2
+        since_better = 0
+  return min(best, upper) if upper is not None else best
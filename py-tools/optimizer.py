@@ -33,27 +33,54 @@ Modules to optimizes the purchase.
 """
 
 import copy
+import datetime
+import distutils.spawn
+import heapq
 import json
 import math
 import os
 import os.path
+import Queue
 import re
+import signal
 import sys
 import subprocess
+import time
 import unicodedata
 import multiprocessing
 
 import lfxml
 import gflags
+import heuristic
 import item
+import lower_bound
+import presolve
+import price_index
+import scheduler
+import subsets
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 FLAGS = gflags.FLAGS
 
 gflags.DEFINE_string(
     'mode', 'builtin',
     '"builtin" runs the built in optimizer that works up to about '
-    '--consider_shops=20. "gplk" will invoke the external glpsol '
-    'linear program solver.')
+    '--consider_shops=20. "bnb" runs a branch and bound search that prunes '
+    'combinations which cannot beat the best one found so far, it works for '
+    'considerably more shops. "mitm" splits the shops into two halves and '
+    'combines the subsets of both, for up to about 36 shops. "heuristic" '
+    'runs a local search for --time_budget seconds that handles hundreds of '
+    'shops, without a proof that its result is optimal. "gplk" will invoke '
+    'the external glpsol linear program solver. "highs" solves the same '
+    'model with the external highs program of the HiGHS solver. '
+    '"portfolio" races the variants of --portfolio against each other. '
+    '"auto" times short trials of the --auto_variants and runs the one that '
+    'can consider the most shops within --time_budget, it sets '
+    '--consider_shops itself.')
 
 gflags.DEFINE_boolean(
     'rerun_solver', False,
@@ -91,8 +118,8 @@ gflags.DEFINE_integer(
     'max_shops', 8,
     'The maximum number of shops to evaluate for any possible combination of '
     'considered shops. Affects --mode=builtin only. Setting this to something '
-    'smaller than consider_shops does not always speed up the time to '
-    'solution, you will have to try with your specific query.')
+    'smaller than consider_shops makes it visit only the combinations of at '
+    'most so many shops, which is a lot faster if it is much smaller.')
 
 gflags.DEFINE_integer(
     'consider_shops', 20,
@@ -101,12 +128,13 @@ gflags.DEFINE_integer(
     'is currently about 25 (depending on machine speed, parallelization, '
     'possibly the value of max_shops, and of course your patience. '
     'With mode=glpk it can be much more, about 60 or 100 may be still ok '
-    'depending on the model.')
+    'depending on the model. Mode=heuristic can consider all shops that '
+    'were fetched, e.g. 500.')
     
 gflags.DEFINE_integer(
     'glpk_limit_seconds', 0,
-    'If non-zero, glpk will spend so much time on finding the optimal '
-    'solution.')
+    'If non-zero, glpk or HiGHS will spend so much time on finding the '
+    'optimal solution.')
 
 gflags.DEFINE_integer(
     'jobs', 1,
@@ -121,6 +149,102 @@ gflags.DEFINE_boolean(
     'depending on both parameters and input data.',
     short_name = 'p')
 
+gflags.DEFINE_boolean(
+    'partial_lots', True,
+    'Also considers lots that have fewer items than needed and splits the '
+    'quantity of such a part across shops. Otherwise only lots that have '
+    'all needed items are offers.')
+
+gflags.DEFINE_boolean(
+    'presolve', True,
+    'Simplifies the model before optimizing: fixes shops that are the only '
+    'source of a part, drops shops that another shop beats on every part, '
+    'removes offers that can never be chosen and merges parts with identical '
+    'offers. The optimal cost stays the same.')
+
+gflags.DEFINE_float(
+    'time_budget', 30.0,
+    'Seconds that --mode=heuristic searches for better combinations, and '
+    'that --mode=auto plans for, its trials included.')
+
+gflags.DEFINE_float(
+    'warm_start_seconds', 0.0,
+    'If non-zero, --mode=glpk and --mode=highs first run the local search of '
+    '--mode=heuristic for so many seconds and report its solution. The '
+    'solver then only looks for cheaper solutions and falls back to this one '
+    'if it finds none in time.')
+
+gflags.DEFINE_float(
+    'target_gap', 0.0,
+    'Stops searching once the cost of the best solution is at most this '
+    'fraction above the lower bound, e.g. 0.01 for 1%. The gap is computed '
+    'as (cost - lower bound) / cost. For --mode=glpk it is glpsol\'s '
+    '--mipgap.',
+    lower_bound=0.0, upper_bound=0.99)
+
+gflags.DEFINE_list(
+    'portfolio', ['bnb', 'heuristic', 'builtin:evaluator=gray'],
+    'The variants that --mode=portfolio runs in parallel, each one a mode '
+    'followed by flags for it, e.g. "glpk:target_gap=0.01:jobs=2". Each '
+    'variant gets one process unless it sets --jobs. The first variant that '
+    'proves its solution optimal wins, otherwise the best one after '
+    '--time_budget seconds.')
+
+gflags.DEFINE_list(
+    'auto_variants',
+    ['builtin', 'builtin:evaluator=gray', 'builtin:evaluator=numpy', 'bnb',
+     'glpk'],
+    'The variants that --mode=auto chooses from, like those of --portfolio. '
+    'A variant that fails, e.g. for a missing module or solver, is left '
+    'out.')
+
+gflags.DEFINE_boolean(
+    'resume', False,
+    'Continues an interrupted search of --mode=builtin, bnb or mitm from its '
+    'checkpoint in --cachedir: skips the combinations it already tried and '
+    'starts from the best price it found. The model and the flags that '
+    'change the search must be the same.')
+
+gflags.DEFINE_boolean(
+    'decompose', True,
+    'Splits the parts into groups that have no candidate shop in common and '
+    'optimizes each group on its own, in parallel with --jobs.')
+
+gflags.DEFINE_enum(
+    'evaluator', 'plain', ['plain', 'numpy', 'gray'],
+    'How the builtin optimizer evaluates shop combinations. "plain" checks '
+    'one combination at a time. "numpy" scores whole blocks of combinations '
+    'with one NumPy call each and needs the numpy module. "gray" walks the '
+    'combinations in Gray code order and updates the price of the previous '
+    'combination for the shops that changed. It pays off most when the '
+    'shops offer many of the parts, so that many combinations have all '
+    'parts; with few offers per part it is about as fast as "plain". '
+    'Affects --mode=builtin only, and only if --max_shops does not limit '
+    'the combinations.')
+
+gflags.DEFINE_boolean(
+    'frontier', False,
+    'Also finds the cheapest orders for each number of shops in the same '
+    'search and prints them as a table of the cost against the number of '
+    'shops. Searches all combinations, ignoring --target_gap and '
+    '--decompose. Affects --mode=builtin only.')
+
+gflags.DEFINE_string(
+    'shop_fix_cost_sweep', '',
+    'Also finds the cheapest orders for each shop fix cost from lo to hi in '
+    'steps of step, given as "lo:hi:step", in the same search: it keeps the '
+    'cheapest combination of each number of shops like --frontier and '
+    'takes the cheapest of them for each fix cost. The candidate shops are '
+    'the ones of --shop_fix_cost. Affects --mode=builtin only.')
+
+gflags.DEFINE_integer(
+    'alternatives', 0,
+    'Also keeps this many of the next cheapest combinations of shops during '
+    'the search and prints them as alternative orders, e.g. for when a shop '
+    'turns out to be on vacation. Only combinations that buy something from '
+    'each of their shops count. Disables --decompose. Affects '
+    '--mode=builtin and bnb only.')
+
 AMPL_MODEL="""
 set Bricks;
 
@@ -129,8 +253,14 @@ set Shops;
 # The demand for each brick.
 param demand{b in Bricks}, integer;
 
-# Unit price of each brick from shop s.
-param unit_price{b in Bricks, s in Shops};
+# The bricks that shop s offers, as pairs (b, s).
+set Offers within {Bricks, Shops};
+
+# Unit price of brick b from shop s.
+param unit_price{(b, s) in Offers};
+
+# Maximum number of bricks b to order from shop s.
+param max_bricks{(b, s) in Offers}, integer;
 
 # Fix cost when ordering from shop s.
 param fix_cost{s in Shops};
@@ -138,39 +268,74 @@ param fix_cost{s in Shops};
 # Minimum order from each shop.
 param min_order{s in Shops};
 
-# Maximum total number of bricks to order from one shop. This can be
-# arbitrarily high but is needed to enforce consistency
-param max_bricks_from_shop;
-
 # Do we order from shop s?
 var order_shop{s in Shops}, binary >= 0;
 
 # How many bricks we order of brick b from shop s?
-var order_brick{b in Bricks, s in Shops} integer >= 0;
+var order_brick{(b, s) in Offers} integer >= 0;
 
 minimize cost:
   sum{s in Shops} order_shop[s] * fix_cost[s] +
-  sum{b in Bricks, s in Shops} order_brick[b,s] * unit_price[b,s];
+  sum{(b, s) in Offers} order_brick[b,s] * unit_price[b,s];
 
 s.t. brick_at_least{b in Bricks}:
-sum{s in Shops} order_brick[b,s] >= demand[b];
+sum{s in Shops: (b, s) in Offers} order_brick[b,s] >= demand[b];
 
 s.t. brick_not_too_much{b in Bricks}:
-sum{s in Shops} order_brick[b,s] <= 10 * demand[b];
+sum{s in Shops: (b, s) in Offers} order_brick[b,s] <= 10 * demand[b];
 
-s.t. brick_shop_sync{b in Bricks, s in Shops}:
-order_shop[s] >= order_brick[b,s] / max_bricks_from_shop;
+s.t. brick_shop_sync{(b, s) in Offers}:
+order_brick[b,s] <= max_bricks[b,s] * order_shop[s];
 
 s.t. shop_at_least{s in Shops}:
-sum{b in Bricks} order_brick[b,s] * unit_price[b,s] >= min_order[s] * order_shop[s];
+sum{b in Bricks: (b, s) in Offers} order_brick[b,s] * unit_price[b,s] >=
+min_order[s] * order_shop[s];
 
-data;
+"""
 
-param max_bricks_from_shop := 10000;
+# Only solutions cheaper than the warm start solution, plus a little for the
+# rounding of the prices.
+AMPL_CUTOFF = """
+s.t. cost_cutoff:
+  sum{s in Shops} order_shop[s] * fix_cost[s] +
+  sum{(b, s) in Offers} order_brick[b,s] * unit_price[b,s] <= %(cutoff).5f;
+"""
+
+# Solves the model and writes only the orders to the solution file, as lines
+# "brick shop quantity". The data section follows.
+AMPL_SOLUTION = """
+solve;
+
+printf "" > "%(file)s";
+printf{(b, s) in Offers: order_brick[b,s] > 0.5}
+  "%%s %%s %%d\\n", b, s, round(order_brick[b,s]) >> "%(file)s";
+
+data;
 
 """
 
-AMPL_UNAVAILABLE_PRICE = 1000;
+# How often a search saves its progress to --cachedir, in seconds.
+CHECKPOINT_SECONDS = 60
+
+# Results of --mode=portfolio in --cachedir, one JSON object per line.
+PORTFOLIO_HISTORY = 'portfolio.history'
+
+# --mode=auto spends at most this share of --time_budget on its trials, and
+# a single trial at most AUTO_TRIAL_SHARE of it.
+AUTO_CALIBRATION_SHARE = 0.2
+AUTO_TRIAL_SHARE = 0.05
+
+# Seconds that --mode=auto times a builtin search on a sample of its
+# combinations.
+AUTO_SAMPLE_SECONDS = 0.1
+
+# Upper limit for the number of (combination, part) cells MinimizePartNumpy
+# keeps in memory at once.
+NUMPY_BLOCK_ELEMENTS = 1 << 21
+
+# MinimizePartGray sums prices as integers of this many units per currency
+# unit, so that adding and removing shops doesn't accumulate rounding errors.
+GRAY_PRICE_SCALE = 100000
 
 class OptimizerBase(object):
   
@@ -184,12 +349,328 @@ class OptimizerBase(object):
     # dict str(part) -> [dict(quantity, unit_price, shop_name)]
     self._shops_for_parts = self._FilterOffers(
         self._parts_needed, shop_data, allow_used)
+    self._shops_for_parts = self._RemoveUnreachableShops(
+        self._parts_needed, self._shops_for_parts)
 
     self._CalculateCandidateShops(self._shops_for_parts, self._parts_needed)
     self._shops_for_parts = self._RemoveExcludedshops(
         self._shops_for_parts, self._shops.keys())
 
+    self._forced_shops = set()
+    part_groups = None
+    if FLAGS.presolve:
+      (self._shops_for_parts, self._shops, self._forced_shops,
+       part_groups) = presolve.Presolve(
+           self._parts_needed, self._shops_for_parts, self._shops)
+
+    self._index = price_index.PriceIndex(
+        self._parts_needed, self._shops_for_parts, self._shops.keys(),
+        self._forced_shops, part_groups)
+    self._max_shops = self._MaxShops()
+    # lower bound of the cost the search proved, and the one of lower_bound
+    self._proven_bound = None
+    self._relaxation_bound = None
+    # dict int(number of shops) -> (price, mask) of the cheapest combination
+    # of that many shops the search found, with --frontier
+    self._frontier = {}
+    # [(price, mask)] of the cheapest combinations, with --alternatives
+    self._alternatives = []
+    # (queue, variant) if this runs as a variant of a PortfolioOptimizer
+    self._portfolio = None
+
+    self._order_bricks = {}
+
+  def Run(self):
+    """
+    Optimizes the orders. Groups of parts that have no candidate shop in
+    common don't influence each other, with --decompose each group is
+    optimized on its own by Solve(). The limit of --max_shops is ignored for
+    the groups, if their orders together take too many shops all parts are
+    optimized together after all.
+    """
+    components = self._Decomposition()
+    if len(components) < 2:
+      return self.Solve()
+    print 'Optimizing %d independent groups of parts.' % len(components)
+
+    # Small groups are solved in parallel, one process each. If one group
+    # has more combinations than all others together, it gets all processes
+    # for itself afterwards.
+    components.sort(key=lambda c: c._index.NumFreeShops())
+    in_process = []
+    if (2 ** components[-1]._index.NumFreeShops() >
+        sum(2 ** c._index.NumFreeShops() for c in components[:-1])):
+      in_process = components[-1:]
+      components = components[:-1]
+
+    # the groups solved or being solved, in the order of their numbers
+    solved = []
+    num_groups = len(components) + len(in_process)
+    try:
+      if FLAGS.jobs > 1:
+        pool = multiprocessing.Pool(
+            processes=min(FLAGS.jobs, len(components)),
+            initializer=InitComponentWorker, initargs=(components,))
+        try:
+          orders = pool.map_async(
+              SolveComponent, xrange(len(components))).get(0xFFFFFFFF)
+        except KeyboardInterrupt:
+          pool.terminate()
+          raise
+        pool.close()
+        pool.join()
+        for k in xrange(len(components)):
+          (components[k]._order_bricks,
+           components[k]._proven_bound) = orders[k]
+        solved.extend(components)
+      else:
+        in_process = components + in_process
+      for component in in_process:
+        # when interrupted, it has the best orders it found so far
+        solved.append(component)
+        component.Solve()
+    except KeyboardInterrupt:
+      self._MergeComponents(solved, num_groups, False)
+      raise
+
+    if not self._MergeComponents(solved, num_groups, True):
+      return
+    components = solved
+    bounds = [c._proven_bound for c in components]
+    if None not in bounds:
+      self._proven_bound = sum(bounds)
+    if (self._max_shops is not None and
+        len(self._order_bricks) > self._max_shops):
+      print ('The groups take %d shops together, more than --max_shops, '
+             'optimizing all parts together.' % len(self._order_bricks))
+      self._order_bricks = {}
+      self._proven_bound = None
+      self.Solve()
+
+  def _MergeComponents(self, components, num_groups, finished):
+    """
+    Sets the orders to those of the solved groups of parts, the first ones
+    of num_groups. Unless finished, groups without orders yet are left out.
+    Returns False if a group has no possible orders.
+    """
     self._order_bricks = {}
+    for k in xrange(len(components)):
+      orders = components[k].Orders()
+      if orders is None:
+        if not finished:
+          continue
+        print 'Group %d of %d: no possible orders.' % (k + 1, num_groups)
+        return False
+      print ('Group %d of %d: %d parts, %d shops, '
+             'best price %.2f from %d shops.' % (
+                 k + 1, num_groups, len(components[k].PartsNeeded()),
+                 components[k]._index.NumShops(),
+                 components[k].NetGrandTotal() +
+                 len(orders) * FLAGS.shop_fix_cost,
+                 len(orders)))
+      self._order_bricks.update(orders)
+    return True
+
+  def Solve(self):
+    raise NotImplementedError
+
+  def _Decomposition(self):
+    """
+    The optimizers of the groups of parts that Run() solves one by one,
+    fewer than two if it solves the whole model at once.
+    """
+    if (FLAGS.decompose and not FLAGS.combinations and not TrackFrontier() and
+        not FLAGS.alternatives):
+      return self._Components()
+    return []
+
+  def ModelHash(self):
+    """Identifies the loaded model and the flags that change its solution."""
+    return '%08x' % (hash(str((
+        self._parts_needed, self._shops_for_parts, FLAGS.shop_fix_cost,
+        self._max_shops))) & 0xffffffff)
+
+  def _CheckpointFileName(self, label, func, total):
+    """The checkpoint file of a search, in --cachedir."""
+    key = str((self.ModelHash(), self._index.shops, self._index.parts, label,
+               func.__name__, total, FLAGS.max_shops, FLAGS.target_gap,
+               TrackFrontier(), FLAGS.alternatives))
+    return '%s/%s.%08x.checkpoint' % (
+        FLAGS.cachedir,
+        os.path.splitext(os.path.basename(self._ldd_file_name))[0],
+        hash(key) & 0xffffffff)
+
+  @staticmethod
+  def _ReadCheckpoint(file_name):
+    """
+    Returns (done ranges, best price, best mask, candidates) of a
+    checkpoint, None if there is none. The candidates are in the format of
+    Candidates.Result().
+    """
+    if not os.path.exists(file_name):
+      return None
+    checkpoint_file = open(file_name, 'r')
+    try:
+      state = json.load(checkpoint_file)
+    except ValueError:
+      print 'Ignoring the broken checkpoint %s' % file_name
+      return None
+    finally:
+      checkpoint_file.close()
+    candidates = {
+        'frontier': dict((count, (price, mask))
+                         for count, price, mask in state.get('frontier', [])),
+        'alternatives': [tuple(a) for a in state.get('alternatives', [])]}
+    return ([tuple(r) for r in state['done']], state['price'], state['mask'],
+            candidates)
+
+  def _WriteCheckpoint(self, file_name, done, price, mask):
+    try:
+      os.makedirs(os.path.dirname(file_name))
+    except OSError:
+      pass
+    # replace the old checkpoint only once the new one is complete
+    checkpoint_file = open(file_name + '.tmp', 'w')
+    try:
+      json.dump({'done': done, 'price': price, 'mask': mask,
+                 'frontier': [(count,) + self._frontier[count]
+                              for count in sorted(self._frontier)],
+                 'alternatives': self._alternatives},
+                checkpoint_file)
+    finally:
+      checkpoint_file.close()
+    os.rename(file_name + '.tmp', file_name)
+
+  def _Share(self, price, mask):
+    """Tells the portfolio this runs in, if any, about a better solution."""
+    if self._portfolio is not None:
+      queue, variant = self._portfolio
+      queue.put(('better', variant, price, mask))
+
+  def _MergeCandidates(self, candidates):
+    """
+    Adds the frontier and the alternatives of a Candidates.Result(), keeping
+    the cheapest of each number of shops and the cheapest combinations.
+    """
+    for count, (price, mask) in candidates.get('frontier', {}).iteritems():
+      if count not in self._frontier or price < self._frontier[count][0]:
+        self._frontier[count] = (price, mask)
+    if 'alternatives' in candidates:
+      prices = dict((mask, price) for price, mask in self._alternatives)
+      for price, mask in candidates['alternatives']:
+        prices[mask] = min(price, prices.get(mask, price))
+      # one more than asked for, the cheapest one is usually the orders
+      self._alternatives = sorted(
+          (price, mask) for mask, price in prices.iteritems()
+          )[:FLAGS.alternatives + 1]
+
+  def Sweep(self):
+    """
+    The cheapest orders for each fix cost of --shop_fix_cost_sweep, as a
+    list of (shop fix cost, gross cost, orders). For each number of shops,
+    the cost of its cheapest combination is a line over the fix cost, the
+    cheapest orders are on the lower envelope of these lines.
+    """
+    result = []
+    if not self._frontier:
+      return result
+    for fix_cost in SweepFixCosts():
+      cost, mask = min(
+          (price + count * (fix_cost - FLAGS.shop_fix_cost), mask)
+          for count, (price, mask) in self._frontier.iteritems())
+      result.append((fix_cost, cost, self._index.Order(mask)))
+    return result
+
+  def Alternatives(self):
+    """
+    The --alternatives cheapest combinations of shops besides the orders,
+    as a list of (gross cost, orders), cheapest first.
+    """
+    shops = set(self._order_bricks)
+    result = []
+    for price, mask in self._alternatives:
+      orders = self._index.Order(mask)
+      if set(orders) != shops:
+        result.append((price, orders))
+    return result[:FLAGS.alternatives]
+
+  def Frontier(self):
+    """
+    The cheapest orders for each number of shops that --frontier found, as a
+    list of (number of shops, gross cost, orders) by the number of shops.
+    Leaves out the numbers of shops that don't cost less than fewer shops.
+    """
+    if not FLAGS.frontier:
+      return []
+    result = []
+    for count in sorted(self._frontier):
+      price, mask = self._frontier[count]
+      if result and price >= result[-1][1]:
+        continue
+      result.append((count, price, self._index.Order(mask)))
+    return result
+
+  def _MaxShops(self):
+    """The maximum number of shops of a solution, None if not limited."""
+    return None
+
+  def _Incumbent(self, price):
+    """
+    The best price for pruning the search, shared by all processes of the
+    search and, in a portfolio, by all variants.
+    """
+    if self._portfolio is not None:
+      incumbent = _variant_incumbent
+      with incumbent.get_lock():
+        if price < incumbent.value:
+          incumbent.value = price
+      return incumbent
+    return multiprocessing.Value('d', price)
+
+  def _Components(self):
+    """Splits the model into optimizers of independent groups of parts."""
+    index = self._index
+    # [(int(shop mask), [int(part)])]
+    groups = []
+    for i in xrange(index.NumParts()):
+      mask = index.part_shops[i]
+      rows = [i]
+      unconnected = []
+      for group in groups:
+        if group[0] & mask:
+          mask |= group[0]
+          rows.extend(group[1])
+        else:
+          unconnected.append(group)
+      groups = unconnected + [(mask, rows)]
+    return [self._Restrict(mask, rows) for mask, rows in groups]
+
+  def _Restrict(self, shop_mask, rows):
+    """Returns a copy of this optimizer for some shops and part groups."""
+    index = self._index
+    part_groups = [index.members[i] for i in rows]
+    shops = index.ShopNames(shop_mask)
+    result = copy.copy(self)
+    result._parts_needed = dict(
+        (p, self._parts_needed[p]) for group in part_groups for p in group)
+    result._shops = dict((s, self._shops[s]) for s in shops)
+    result._shops_for_parts = dict(
+        (p, [o for o in self._shops_for_parts[p]
+             if o['shop_name'] in result._shops])
+        for p in result._parts_needed)
+    result._forced_shops = self._forced_shops.intersection(shops)
+    result._index = price_index.PriceIndex(
+        result._parts_needed, result._shops_for_parts, shops,
+        result._forced_shops, part_groups)
+    result._max_shops = None
+    result._proven_bound = None
+    result._relaxation_bound = None
+    result._frontier = {}
+    result._alternatives = []
+    # the masks of a part of the model mean nothing to the portfolio
+    result._portfolio = None
+    result._order_bricks = {}
+    return result
 
   def PartsNeeded(self):
     return self._parts_needed
@@ -198,7 +679,7 @@ class OptimizerBase(object):
     return sum(self._parts_needed[p] for p in self._parts_needed)
 
   def NumShopsAvailable(self, part):
-    return len(self._shops_for_parts[part])
+    return len(self._index.part_offers[self._index.part_ids[part]])
 
   def CriticalShops(self):
     return self._critical_shops
@@ -215,11 +696,59 @@ class OptimizerBase(object):
     return self._order_bricks
 
   def UnitPrice(self, shop, part):
-    for s in self._shops_for_parts[part]:
-      if s['shop_name'] == str(shop):
-        return s['unit_price']
-    return None
+    offer = self.Offer(shop, part)
+    if offer is None:
+      return None
+    return offer['unit_price']
+
+  def Offer(self, shop, part):
+    j = self._index.shop_ids.get(str(shop))
+    if j is None:
+      return None
+    return self._index.Offer(part, j)
         
+  def _Offers(self):
+    """
+    The offers of the price index as [(int(part), int(shop), float(unit
+    price), int(max bricks))]. No more than the lot is ordered. Ordering
+    more than needed is only worth it to reach the minimum buy of the shop,
+    and at most price_index.MAX_ORDER_FACTOR times the needed quantity is
+    ordered.
+    """
+    index = self._index
+    min_buy = [self._shops[s]['min_buy'] for s in index.shops]
+    return [(i, j, price,
+             min(index.Quantity(i, j), index.demand[i] *
+                 (price_index.MAX_ORDER_FACTOR if min_buy[j] > 0 else 1)))
+            for i in xrange(index.NumParts())
+            for j, price in index.part_offers[i]]
+
+  def _WarmStart(self):
+    """
+    Runs the local search of --mode=heuristic for --warm_start_seconds and
+    reports its solution. Returns (price, mask, bool(within --target_gap of
+    the lower bound)) of it, None if there is none.
+    """
+    if not FLAGS.warm_start_seconds:
+      return None
+    start_time = time.time()
+    target = None
+    bound = self.LowerBound()
+    if bound is not None:
+      target = bound / (1 - FLAGS.target_gap) + 1e-9
+    price, mask = heuristic.Search(
+        self._index, FLAGS.shop_fix_cost,
+        start_time + FLAGS.warm_start_seconds, target=target)
+    if mask is None:
+      print 'Warm start: no solution found.'
+      return None
+    proven = target is not None and price <= target
+    print 'Warm start: price %.2f from %d shops after %.1f seconds%s.' % (
+        price, bin(mask).count('1'), time.time() - start_time,
+        ', within --target_gap of the lower bound' if proven else '')
+    sys.stdout.flush()
+    return (price, mask, proven)
+
   def NetShopTotal(self, shop):
     return sum(
         self.UnitPrice(shop, part) * self._order_bricks[shop][part]
@@ -230,6 +759,52 @@ class OptimizerBase(object):
         self.NetShopTotal(shop)
         for shop in self._order_bricks)
 
+  def GrossGrandTotal(self):
+    return (self.NetGrandTotal() +
+            len(self._order_bricks) * FLAGS.shop_fix_cost)
+
+  def LowerBound(self):
+    """
+    Lower bound of the gross cost of any solution, None if there is none.
+    It is the cost of the orders if the optimizer proved them optimal.
+    """
+    bounds = [self._proven_bound]
+    if (self._proven_bound is None or not self._order_bricks or
+        self._proven_bound < self.GrossGrandTotal()):
+      if self._relaxation_bound is None:
+        upper = None
+        if self._order_bricks:
+          upper = self.GrossGrandTotal()
+        self._relaxation_bound = lower_bound.LowerBound(
+            self._index, FLAGS.shop_fix_cost, upper)
+      bounds.append(self._relaxation_bound)
+    bounds = [b for b in bounds if b is not None]
+    if not bounds:
+      return None
+    return max(bounds)
+
+  def Gap(self):
+    """(cost - lower bound) / cost of the orders, None if unknown."""
+    bound = self.LowerBound()
+    if bound is None or not self._order_bricks:
+      return None
+    cost = self.GrossGrandTotal()
+    if cost <= 0:
+      return 0.0
+    return max(0.0, (cost - bound) / cost)
+
+  def _TargetPrice(self):
+    """
+    The price of a solution that is good enough with --target_gap, None if
+    every solution has to be looked at.
+    """
+    if not FLAGS.target_gap:
+      return None
+    bound = self.LowerBound()
+    if bound is None:
+      return None
+    return bound / (1 - FLAGS.target_gap)
+
   @staticmethod
   def _GetPartsNeeded(parts, allow_used):
     parts_needed = copy.copy(parts)
@@ -245,7 +820,7 @@ class OptimizerBase(object):
         continue
       new_shops = []
       for s in shops_for_parts[p]:
-        if (s['quantity'] >= parts_needed[p]
+        if ((s['quantity'] >= parts_needed[p] or FLAGS.partial_lots)
             and (s['condition'] == 'N'
                 or p in allow_used or p.condition()=='A')
             and (not FLAGS.include_shops
@@ -257,13 +832,29 @@ class OptimizerBase(object):
             and (s['location'] not in FLAGS.exclude_countries
                 or s['shop_name'] in FLAGS.dont_exclude_shops)):
           new_shops.append(s)
+      if FLAGS.partial_lots:
+        new_shops = OptimizerBase._OneLotPerShop(new_shops, parts_needed[p])
       filtered_shops_for_parts[p] = new_shops
     return filtered_shops_for_parts
 
+  @staticmethod
+  def _OneLotPerShop(offers, needed):
+    """
+    Keeps one lot of each shop of the offers: its cheapest lot that is big
+    enough for the needed quantity, otherwise its biggest lot.
+    """
+    best = {}
+    for s in offers:
+      other = best.get(s['shop_name'])
+      if (other is None or
+          (min(s['quantity'], needed), -s['unit_price']) >
+          (min(other['quantity'], needed), -other['unit_price'])):
+        best[s['shop_name']] = s
+    return [s for s in offers if best[s['shop_name']] is s]
+
   def _CalculateCandidateShops(self, shops_for_parts, parts_needed):
     if (len(parts_needed) == 0):
-      print "There is nothing to optimize, got an empty list."
-      sys.exit(0)
+      raise NameError('There is nothing to optimize, got an empty list.')
     # shops that we must take on the list to guarantee that we
     # have at least one shop for the part.
     critical_shops = {}
@@ -286,21 +877,25 @@ class OptimizerBase(object):
     BaP = 'Lego Bricks and Pieces'
     for p in parts_by_rarity:
       part = p[0]
-      existing_shops = (
-          set(s['shop_name'] for s in shops_for_parts[part])
-          .intersection(critical_shops.keys()))
-      found = False
-      if not existing_shops:
-        # We need one more critical shop, we use the cheapest for the part.
+      # With --partial_lots one shop might not have enough of the part.
+      available = sum(
+          s['quantity'] for s in shops_for_parts[part]
+          if s['shop_name'] in critical_shops)
+      found = available >= parts_needed[part]
+      if not found:
+        # We need more critical shops, we use the cheapest for the part.
         for s in shops_for_parts[part]:
           if (s['shop_name'] not in FLAGS.exclude_shops and
-              s['shop_name'] != BaP):
+              s['shop_name'] != BaP and
+              s['shop_name'] not in critical_shops):
             critical_shops[s['shop_name']] = {
                 'type': 'critical',
                 'min_buy': s['min_buy'],
                 'location': s['location']}
-            found = True
-            break
+            available += s['quantity']
+            found = available >= parts_needed[part]
+            if found:
+              break
         assert found or FLAGS.bap and BaP in set(
                 s['shop_name'] for s in shops_for_parts[part]),(
                 'Element %s was not found. This can mean: 1) The part '
@@ -349,9 +944,9 @@ class OptimizerBase(object):
     self._critical_shops = copy.copy(critical_shops)
 
     if (FLAGS.consider_shops <= len(critical_shops)):
-      print "You have to allow to consider at least %d shops for this query." % (
-            len(critical_shops)+1)
-      sys.exit(1)
+      raise NameError(
+          'You have to allow to consider at least %d shops for this query.' % (
+              len(critical_shops)+1))
     assert len(critical_shops) < FLAGS.consider_shops
     supplemental_list = sorted(
         (s for s in supplemental_shops),
@@ -381,11 +976,183 @@ class OptimizerBase(object):
       result[p] = l
     return result
 
+  @staticmethod
+  def _RemoveUnreachableShops(parts_needed, shops_for_parts):
+    """
+    Returns shops_for_parts without the offers of the shops that can't
+    reach their minimum buy even buying their whole lot, up to
+    price_index.MAX_ORDER_FACTOR times the needed quantity, of every part
+    they offer. Every combination with one of them is infeasible, so they
+    must not take the place of a candidate shop.
+    """
+    reachable = {}
+    min_buy = {}
+    for p in shops_for_parts:
+      for s in shops_for_parts[p]:
+        reachable[s['shop_name']] = reachable.get(s['shop_name'], 0.0) + (
+            s['unit_price'] * min(
+                s['quantity'],
+                parts_needed[p] * price_index.MAX_ORDER_FACTOR))
+        min_buy[s['shop_name']] = s['min_buy']
+    unreachable = sorted(
+        s for s in reachable if reachable[s] < min_buy[s] - 1e-9)
+    if not unreachable:
+      return shops_for_parts
+    print 'Leaving out %d shops that can\'t reach their minimum buy: %s' % (
+        len(unreachable), ', '.join(unreachable))
+    unreachable = set(unreachable)
+    return dict(
+        (p, [s for s in shops_for_parts[p]
+             if s['shop_name'] not in unreachable])
+        for p in shops_for_parts)
+
 """ Internal Optimizer class """
 
+"""
+Independent groups of parts to be solved by the worker processes of
+OptimizerBase.Run, one group per task and process.
+"""
+_worker_components = None
+
+def InitComponentWorker(components):
+  global _worker_components
+  _worker_components = components
+  # each group gets a single process, and its progress would only garble
+  # the output of the others
+  FLAGS.jobs = 1
+  sys.stdout = open(os.devnull, 'w')
+
+def SolveComponent(k):
+  _worker_components[k].Solve()
+  return (_worker_components[k]._order_bricks,
+          _worker_components[k]._proven_bound)
+
+"""
+State of the worker processes. The optimizer is handed to each worker once
+by the pool initializer (with fork it is simply shared copy-on-write), so
+the tasks themselves only carry the bounds of their range and return the
+best price with the bit mask of its shops.
+"""
+_worker_optimizer = None
+# Best price of all workers, if the search can use it for pruning.
+_worker_incumbent = None
+# Candidates that a search keeps from one task to the next for pruning.
+_worker_candidates = None
+# Lowest Candidates.threshold of all workers, if the search shares it.
+_worker_threshold = None
+# One flag per shop of the best combination of all workers, with
+# --mode=heuristic, whose orders are printed if it is interrupted.
+_worker_best_shops = None
+
+def InitWorker(optimizer, incumbent=None, threshold=None, best_shops=None):
+  global _worker_optimizer, _worker_incumbent, _worker_candidates
+  global _worker_threshold, _worker_best_shops
+  _worker_optimizer = optimizer
+  _worker_incumbent = incumbent
+  _worker_candidates = None
+  _worker_threshold = threshold
+  _worker_best_shops = best_shops
+
+def RunWorkerTask(func, start, end):
+  return func(_worker_optimizer, start, end)
+
+class Candidates(object):
+  """
+  The combinations a worker keeps besides the cheapest one: with --frontier
+  the cheapest one of each number of shops, with --alternatives the
+  cheapest ones that buy something from each of their shops. The worker
+  returns Result() instead of (price, mask), the optimizer merges them in
+  _MergeCandidates().
+  """
+
+  @staticmethod
+  def Create(index, frontier=True, scale=1):
+    """A Candidates for the flags, None if they don't ask for any."""
+    frontier = frontier and TrackFrontier()
+    if not frontier and not FLAGS.alternatives:
+      return None
+    return Candidates(index, frontier, scale)
+
+  def __init__(self, index, frontier, scale=1):
+    self._index = index
+    # the prices of the worker are in units of 1 / scale
+    self._scale = scale
+    # dict int(number of shops) -> (price, mask)
+    self._frontier = {} if frontier else None
+    # heap of (-price, mask), the most expensive alternative first
+    self._heap = []
+    # one more than asked for, the cheapest one is usually the orders
+    self._size = FLAGS.alternatives + 1 if FLAGS.alternatives else 0
+    # a combination has to be cheaper than this to become an alternative
+    self.threshold = float('inf') if self._size else float('-inf')
+
+  def FrontierPrice(self, count):
+    """The price a combination of count shops has to beat for the
+    frontier."""
+    if self._frontier is None:
+      return float('-inf')
+    if count not in self._frontier:
+      return float('inf')
+    return self._frontier[count][0]
+
+  def Add(self, price, mask, count):
+    """
+    Considers the combination mask of count shops for price. The price may
+    be a lower bound that ignores the minimum buy of the shops and the
+    quantity of their lots, see PriceIndex, the exact price is only worked
+    out if the combination would be kept.
+    """
+    if price >= self.FrontierPrice(count) and price >= self.threshold:
+      return
+    if mask & self._index.repair_mask:
+      price = self._index.TotalCost(mask, FLAGS.shop_fix_cost)
+      if price is None:
+        return
+      price *= self._scale
+    if price < self.FrontierPrice(count):
+      self._frontier[count] = (price, mask)
+    if price >= self.threshold:
+      return
+    for other_price, other_mask in self._heap:
+      if other_mask == mask:
+        return
+    # with a shop that it buys nothing from, the same orders without that
+    # shop are cheaper, it's no alternative
+    used = self._index.NumUsedShops(mask)
+    if used is None or used < count:
+      return
+    if len(self._heap) < self._size:
+      heapq.heappush(self._heap, (-price, mask))
+    else:
+      heapq.heapreplace(self._heap, (-price, mask))
+    if len(self._heap) == self._size:
+      self.threshold = -self._heap[0][0]
+
+  def Result(self, price, mask, reprice=False):
+    """
+    The result of a worker whose cheapest combination is mask for price.
+    With reprice the prices of the candidates are calculated again, for
+    workers that compare scaled or rounded prices.
+    """
+    def Price(other_price, other_mask):
+      if reprice:
+        return self._index.TotalCost(other_mask, FLAGS.shop_fix_cost)
+      return other_price
+    candidates = {}
+    if self._frontier is not None:
+      candidates['frontier'] = dict(
+          (count, (Price(other_price, other_mask), other_mask))
+          for count, (other_price, other_mask) in self._frontier.iteritems())
+    if self._size:
+      candidates['alternatives'] = [
+          (Price(-other_price, other_mask), other_mask)
+          for other_price, other_mask in self._heap]
+    return (price, mask, candidates)
+
 """
 Do part of the possible shop combinations, to be executed by one of
-possibly many processes.
+possibly many processes. Combination i takes the free shops of the bits of
+i and all forced shops.
 Note: This has to be a globally visible function instead of a member function
       of the BuiltinOptimizer class (which would look much better), because
       python's multiprocessing library cannot "pickle" class member functions,
@@ -401,286 +1168,1176 @@ def MinimizePart(self, i_start, i_end):
       count += 1
     return count
 
-  shop_keys = sorted(self._shops.keys())
-  shop_prices = {}
-  for p in self._parts_needed:
-    shop_prices[p] = { s['shop_name']: s['unit_price']
-                       for s in self._shops_for_parts[p] }
+  index = self._index
+  part_shops = index.part_shops
+  forced = index.forced_mask
+  min_buy_mask = index.min_buy_mask
+  max_shops = self._max_shops
+  candidates = Candidates.Create(index)
 
   best_price = 1.e10
-  best_list  = None
-  best_order = None
+  best_i = None
   for i in xrange(i_start, i_end):
+    i |= forced
     # abort early if this combination contains 'too many shops'
-    if (FLAGS.consider_shops > FLAGS.max_shops and
-                 BitCount(i) > FLAGS.max_shops):
+    if (max_shops is not None and BitCount(i) > max_shops):
       continue
     # quick way to see if this combination has all parts available
     possible = True
-    for p in self._parts_needed:
-      if (not (self.shops_have_part[p] & i)):
+    for shops in part_shops:
+      if (not (shops & i)):
         possible = False
         break
     if (possible):
-      # generate list of shops from integer
-      shops = [
-        shop_keys[j]
-        for j in xrange(len(self._shops))
-        if i & 1 << j]
-      price = 0.0
-      for p in self._parts_needed:
-        prices = [shop_prices[p][s]
-                  for s in set(shops) & set(shop_prices[p].keys())]
-        if len(prices) > 0:
-          min_price = min(prices)
-          price += min_price * self._parts_needed[p]
-        else:
-          price = -1e-10
-      price = price + len(shops) * FLAGS.shop_fix_cost
+      count = BitCount(i)
+      net = index.NetCost(i)
+      # the lots of the shops may not have enough of a part
+      if net is None:
+        continue
+      price = net + count * FLAGS.shop_fix_cost
+      # the minimum buy only adds to the price, it's only worked out for
+      # the combinations that may be the best
+      if price < best_price and i & min_buy_mask:
+        price = index.TotalCost(i, FLAGS.shop_fix_cost)
+        if price is None:
+          continue
+      if price < best_price:
+        best_price = price
+        best_i = i
+      if candidates is not None:
+        candidates.Add(price, i, count)
+  if candidates is not None:
+    return candidates.Result(best_price, best_i)
+  return (best_price, best_i)
+
+"""
+Same as MinimizePart, but i_start..i_end are ranks of subsets of the free
+shops, from self._subset_offset on, see subsets.py. Only these subsets are
+visited, instead of all combinations and skipping the ones with too many
+shops.
+"""
+def MinimizeSubsets(self, i_start, i_end):
+  index = self._index
+  part_shops = index.part_shops
+  forced = index.forced_mask
+  min_buy_mask = index.min_buy_mask
+  candidates = Candidates.Create(index)
 
-      if price >= 0 and price < best_price:
+  best_price = 1.e10
+  best_i = None
+  for i in subsets.Subsets(index.NumFreeShops(),
+                           self._subset_offset + i_start,
+                           self._subset_offset + i_end):
+    i |= forced
+    # quick way to see if this combination has all parts available
+    possible = True
+    for shops in part_shops:
+      if (not (shops & i)):
+        possible = False
+        break
+    if (possible):
+      count = bin(i).count('1')
+      net = index.NetCost(i)
+      if net is None:
+        continue
+      price = net + count * FLAGS.shop_fix_cost
+      if price < best_price and i & min_buy_mask:
+        price = index.TotalCost(i, FLAGS.shop_fix_cost)
+        if price is None:
+          continue
+      if price < best_price:
         best_price = price
-        best_list  = shops
-        best_order = {}
-        for p in self._parts_needed:
-          prices = {shop_prices[p][s] : s
-                    for s in set(shops) & set(shop_prices[p].keys())}
-          min_price = min(prices)
-          best_order.setdefault(prices[min_price],{})[p] = self._parts_needed[p]
-  return (best_price, best_list, best_order)
+        best_i = i
+      if candidates is not None:
+        candidates.Add(price, i, count)
+  if candidates is not None:
+    return candidates.Result(best_price, best_i)
+  return (best_price, best_i)
 
-class BuiltinOptimizer(OptimizerBase):
-  def next_combination(self, l):
-    n = len(l)
-    # find tail
-    last = n-1 # tail is from `last` to end
-    while last > 0:
-        if l[last-1] < l[last]: break
-        last -= 1
-    # increase the number just before tail
-    if last > 0:
-        small = l[last-1]
-        big = n-1
-        while l[big] <= small: big -= 1
-        l[last-1], l[big] = l[big], small
-    # reverse tail
-    i = last
-    j = n-1
-    while i < j:
-        l[i], l[j] = l[j], l[i]
-        i += 1
-        j -= 1
-    return last>0
+"""
+Same as MinimizePart, but visits the combinations of i_start..i_end in Gray
+code order: combination i is i ^ (i >> 1), so each step adds or removes
+exactly one shop and only the parts of that shop need to be updated.
+For each part, the ranks of the offering shops in the current combination
+are kept in a bit mask, ordered by price, so its lowest bit is always the
+cheapest shop even after removing the previous cheapest one.
+"""
+def MinimizePartGray(self, i_start, i_end):
+  if (i_start >= i_end):
+    return (1.e10, None)
+  index = self._index
+  num_shops = index.NumShops()
+  candidates = Candidates.Create(index, scale=GRAY_PRICE_SCALE)
+
+  # rank_prices[r][k]: price of the k-th cheapest offer of part r
+  rank_prices = []
+  # shop_offers[j]: [(part index, rank bit, price)] of shop j
+  shop_offers = [[] for j in xrange(num_shops)]
+  for r in xrange(index.NumParts()):
+    offers = index.part_offers[r]
+    rank_prices.append([
+        int(round(price * index.demand[r] * GRAY_PRICE_SCALE))
+        for j, price in offers])
+    for k in xrange(len(offers)):
+      shop_offers[offers[k][0]].append((r, 1 << k, rank_prices[r][k]))
+
+  rank_masks = [0] * index.NumParts()
+  state = {'total': 0, 'uncovered': index.NumParts()}
+
+  def AddShop(j):
+    total = state['total']
+    for r, bit, price in shop_offers[j]:
+      mask = rank_masks[r]
+      if not mask:
+        state['uncovered'] -= 1
+        total += price
+      else:
+        lowest = mask & -mask
+        if bit < lowest:
+          total += price - rank_prices[r][lowest.bit_length() - 1]
+      rank_masks[r] = mask | bit
+    state['total'] = total
+
+  def RemoveShop(j):
+    total = state['total']
+    for r, bit, price in shop_offers[j]:
+      mask = rank_masks[r] ^ bit
+      rank_masks[r] = mask
+      if bit < (mask & -mask):
+        total += rank_prices[r][(mask & -mask).bit_length() - 1] - price
+      elif not mask:
+        state['uncovered'] += 1
+        total -= price
+    state['total'] = total
+
+  fix_cost = int(round(FLAGS.shop_fix_cost * GRAY_PRICE_SCALE))
+  max_shops = self._max_shops
+  part_shops = index.part_shops
+  gray = (i_start ^ (i_start >> 1)) | index.forced_mask
+  for j in xrange(num_shops):
+    if gray & 1 << j:
+      AddShop(j)
+  count = bin(gray).count('1')
+  # The prices are only brought up to date from the combination they are
+  # for, synced, when the shops of a part that was left uncovered last time
+  # are in the combination again. On sparse models most combinations miss
+  # a part, and this is cheaper than updating the prices for each of them.
+  synced = gray
+  blocker_shops = part_shops[rank_masks.index(0)] if state['uncovered'] else 0
+
+  best_price = None
+  best_gray = None
+  for i in xrange(i_start, i_end):
+    if i != i_start:
+      # the bit flipped between i-1 and i is the lowest set bit of i
+      bit = i & -i
+      gray ^= bit
+      if gray & bit:
+        count += 1
+      else:
+        count -= 1
+    if (max_shops is not None and count > max_shops):
+      continue
+    if blocker_shops and not gray & blocker_shops:
+      continue
+    changed = gray ^ synced
+    while changed:
+      bit = changed & -changed
+      changed ^= bit
+      if gray & bit:
+        AddShop(bit.bit_length() - 1)
+      else:
+        RemoveShop(bit.bit_length() - 1)
+    synced = gray
+    if state['uncovered']:
+      blocker_shops = part_shops[rank_masks.index(0)]
+      continue
+    blocker_shops = 0
+    price = state['total'] + count * fix_cost
+    if ((best_price is None or price < best_price) and
+        gray & index.repair_mask):
+      price = index.TotalCost(gray, FLAGS.shop_fix_cost)
+      if price is None:
+        continue
+      price = int(round(price * GRAY_PRICE_SCALE))
+    if best_price is None or price < best_price:
+      best_price = price
+      best_gray = gray
+    if candidates is not None:
+      candidates.Add(price, gray, count)
+
+  if best_gray is None:
+    return (1.e10, None)
+  best_price = index.TotalCost(best_gray, FLAGS.shop_fix_cost)
+  if candidates is not None:
+    return candidates.Result(best_price, best_gray, reprice=True)
+  return (best_price, best_gray)
 
-  def RunCombinations(self):
-    sys.stdout.write('Optimizing using only potentially viable combinations.\n')
-    sys.stdout.flush()
+"""
+Same as MinimizePart, but scores blocks of combinations with numpy.
+The combinations of a block share all high bits and enumerate all values of
+the low bits, so the per-part minimum prices of the whole block can be built
+by doubling the table once for every low bit, instead of looking at every
+shop of every combination.
+"""
+def MinimizePartNumpy(self, i_start, i_end):
+  index = self._index
+  num_parts = index.NumParts()
+  num_shops = index.NumShops()
+
+  # shops x parts, total price of the needed quantity, inf if not offered
+  prices = numpy.frombuffer(index.prices, dtype=numpy.float64).reshape(
+      (num_parts, num_shops))
+  columns = (prices * numpy.array(index.demand, dtype=numpy.float64)
+             .reshape((num_parts, 1))).T.copy()
+
+  low_bits = 0
+  while (low_bits < index.NumFreeShops() and
+         (2 << low_bits) * max(num_parts, 1) <= NUMPY_BLOCK_ELEMENTS):
+    low_bits += 1
+  block_size = 1 << low_bits
+  low_counts = numpy.zeros(block_size, dtype=numpy.int64)
+  for k in xrange(low_bits):
+    low_counts[1 << k:2 << k] = low_counts[:1 << k] + 1
+  max_shops = self._max_shops
+  candidates = Candidates.Create(index)
 
-    # optimization: build dict that is used later for quick lookup whether
-    # a certain combination of shops actually provides all necessary parts
-    self.shops_have_part = {}
-    shops = sorted(self._shops.keys())
-    for p in self._parts_needed:
-      self.shops_have_part[p] = 0
-      for j in xrange(len(shops)):
-        if (shops[j] in [ s['shop_name'] for s in self._shops_for_parts[p] ]):
-          self.shops_have_part[p] += 1 << j
-
-    shop_keys = sorted(self._shops.keys())
-    shop_prices = {}
-    for p in self._parts_needed:
-      shop_prices[p] = { s['shop_name']: s['unit_price']
-                         for s in self._shops_for_parts[p] }
-    best_price = 1.e10
-    best_list  = None
-    best_order = None
-
-    bits = ((FLAGS.consider_shops-FLAGS.max_shops)*[0] +
-             FLAGS.max_shops*[1])
-    # do-while loop (break at the loop end)
-    while True:
-      bits_int = int("".join(map(str, bits)), 2)
-      possible = True
-      theseshops = [
-        shop_keys[j]
-        for j in xrange(len(self._shops)) if bits_int & 1<<j]
-      for p in self._parts_needed:
-        if (not (self.shops_have_part[p] & bits_int)):
-          possible = False
+  best_price = 1.e10
+  best_i = None
+  table = numpy.empty((block_size, num_parts))
+  for base in xrange(i_start - i_start % block_size, i_end, block_size):
+    high_count = 0
+    table[0].fill(numpy.inf)
+    for j in xrange(low_bits, num_shops):
+      if (base | index.forced_mask) & 1 << j:
+        numpy.minimum(table[0], columns[j], table[0])
+        high_count += 1
+    if (max_shops is not None and high_count > max_shops):
+      continue
+    for k in xrange(low_bits):
+      numpy.minimum(table[:1 << k], columns[k], table[1 << k:2 << k])
+    costs = table.sum(axis=1)
+    counts = low_counts + high_count
+    costs += counts * FLAGS.shop_fix_cost
+    if (max_shops is not None):
+      costs[counts > max_shops] = numpy.inf
+    # only look at the combinations this call is responsible for
+    lo = max(i_start - base, 0)
+    hi = min(i_end - base, block_size)
+    if not index.repair_mask:
+      k = lo + int(numpy.argmin(costs[lo:hi]))
+      if costs[k] < best_price:
+        best_price = costs[k]
+        best_i = (base + k) | index.forced_mask
+    else:
+      # The costs ignore the minimum buy and the quantity of the lots,
+      # which only add to them. The combinations are repaired cheapest
+      # first, until the cost alone can't beat the best price.
+      cheaper = lo + numpy.flatnonzero(costs[lo:hi] < best_price)
+      for k in cheaper[numpy.argsort(costs[cheaper], kind='mergesort')]:
+        if costs[k] >= best_price:
           break
-      if (possible):
-        # generate list of shops from integer
-        theseshops = [
-          shop_keys[j]
-          for j in xrange(len(self._shops)) if bits_int & 1<<j]
-        price = 0.0
-        for p in self._parts_needed:
-          prices = [shop_prices[p][s]
-                    for s in set(theseshops) & set(shop_prices[p].keys())]
-          if len(prices) > 0:
-            min_price = min(prices)
-            price += min_price * self._parts_needed[p]
+        i = (base + int(k)) | index.forced_mask
+        price = index.TotalCost(i, FLAGS.shop_fix_cost)
+        if price is not None and price < best_price:
+          best_price = price
+          best_i = i
+    if candidates is not None:
+      # the cheapest of each number of shops for the frontier
+      if TrackFrontier():
+        for count in numpy.unique(counts[lo:hi]):
+          same = lo + numpy.flatnonzero(counts[lo:hi] == count)
+          if index.repair_mask:
+            same = same[numpy.argsort(costs[same], kind='mergesort')]
           else:
-            price = -1e10
-        price = price + len(theseshops) * FLAGS.shop_fix_cost
+            same = same[[numpy.argmin(costs[same])]]
+          for k in same:
+            if costs[k] >= candidates.FrontierPrice(int(count)):
+              break
+            candidates.Add(float(costs[k]),
+                           (base + int(k)) | index.forced_mask,
+                           int(counts[k]))
+      # the alternatives cheapest first, until they are too expensive
+      cheaper = lo + numpy.flatnonzero(
+          costs[lo:hi] < min(candidates.threshold, numpy.inf))
+      for k in cheaper[numpy.argsort(costs[cheaper], kind='mergesort')]:
+        if costs[k] >= candidates.threshold:
+          break
+        candidates.Add(float(costs[k]), (base + int(k)) | index.forced_mask,
+                       int(counts[k]))
 
-        if price >= 0 and price < best_price:
-          best_price = price
-          best_list  = theseshops
-          best_order = {}
-          for p in self._parts_needed:
-            prices = {shop_prices[p][s] : s
-                      for s in set(theseshops) & set(shop_prices[p].keys())}
-            min_price = min(prices)
-            best_order.setdefault(prices[min_price],{})[p] = self._parts_needed[p]
-          self._order_bricks = best_order
-      if not self.next_combination(bits):
-        break;
-    return (best_price, best_list, best_order)
-    
-  def Run(self):
+  if best_i is None:
+    return (1.e10, None)
+  best_price = index.TotalCost(best_i, FLAGS.shop_fix_cost)
+  if candidates is not None:
+    return candidates.Result(best_price, best_i, reprice=True)
+  return (best_price, best_i)
+
+class BuiltinOptimizer(OptimizerBase):
+  def _MaxShops(self):
+    if (FLAGS.consider_shops > FLAGS.max_shops and
+        FLAGS.max_shops < self._index.NumShops()):
+      return FLAGS.max_shops
+    return None
+
+  def RunCombinations(self):
+    """Tries only the combinations of exactly --max_shops shops."""
+    enumeration = self._Enumeration()
+    if enumeration is not None:
+      label, func, total = enumeration
+      self._Schedule(label, 'combinations', func, total)
+    # fewer shops may be cheaper, so this proves nothing
+    self._proven_bound = None
+
+  def Solve(self):
     # Run "combinations" solver if requested. This is currently not split into a
-    # separate class because ideally a user shouldn't need to specify this, but
-    # instead a short trial should be run, determining which method is faster
-    # for a given run, and choose that.
+    # separate class, --mode=auto can time a short trial of it and choose
+    # whichever method is faster for a given run, see --auto_variants.
     if (FLAGS.combinations):
       return self.RunCombinations()
-    sys.stdout.write('Optimizing...')
+    enumeration = self._Enumeration()
+    if enumeration is not None:
+      label, func, total = enumeration
+      self._Schedule(label, 'combinations', func, total)
+
+  def _Enumeration(self):
+    """
+    The combinations Solve() tries as (label, func, total), it runs
+    func(self, start, end) on all of [0, total). None if there are none.
+    """
+    index = self._index
+    num_free = index.NumFreeShops()
+    if (FLAGS.combinations):
+      # the forced shops are always taken, choose the rest from the free ones
+      num_taken = FLAGS.max_shops - (index.NumShops() - num_free)
+      if (num_taken < 0):
+        return None
+      num_taken = min(num_taken, num_free)
+      # the subsets of num_taken shops follow all smaller ones
+      self._subset_offset = subsets.Count(num_free, num_taken - 1)
+      return ('Optimizing using only potentially viable combinations...',
+              MinimizeSubsets, subsets.Binomial(num_free, num_taken))
+    if self._max_shops is not None:
+      # only the subsets of the free shops that are small enough
+      num_taken = self._max_shops - (index.NumShops() - num_free)
+      if num_taken < 0:
+        return None
+      if num_taken < num_free:
+        self._subset_offset = 0
+        return ('Optimizing...', MinimizeSubsets,
+                subsets.Count(num_free, num_taken))
+    # loop over all possible combinations of the free shops, comparing price
+    total = 2 ** num_free
+    if (FLAGS.evaluator == 'numpy'):
+      minimize_func = MinimizePartNumpy
+    elif (FLAGS.evaluator == 'gray'):
+      minimize_func = MinimizePartGray
+    else:
+      minimize_func = MinimizePart
+    return ('Optimizing...', minimize_func, total)
+
+  def _Schedule(self, label, unit, func, total,
+                best_price=1.e10, best_mask=None, incumbent=None,
+                threshold=None):
+    """
+    Runs func(self, start, end) for all of [0, total) on --jobs processes
+    and sets the orders to the cheapest (price, shop mask) any call returned.
+    Stops early once that is within --target_gap of the lower bound. The
+    result is proven optimal if all of the range was searched.
+
+    The progress is saved to a checkpoint every CHECKPOINT_SECONDS and on
+    Ctrl+C, --resume continues from there.
+    """
+    target = self._TargetPrice()
+    best = {'price': best_price, 'mask': best_mask}
+    all_shops = (1 << self._index.NumShops()) - 1
+    checkpoint = self._CheckpointFileName(label, func, total)
+    skip = []
+    state = None
+    if FLAGS.resume:
+      state = self._ReadCheckpoint(checkpoint)
+    if state is not None:
+      skip, price, mask, candidates = state
+      self._MergeCandidates(candidates)
+      if mask is not None and price < best['price']:
+        best['price'] = price
+        best['mask'] = mask
+        if incumbent is not None:
+          with incumbent.get_lock():
+            incumbent.value = min(incumbent.value, price)
+      print 'Resuming from %s: %d of %d %s done.' % (
+          checkpoint, sum(end - start for start, end in skip), total, unit)
+    last_checkpoint = [time.time()]
+    sys.stdout.write(label)
     sys.stdout.flush()
-    # optimization: build dict that is used later for quick lookup whether
-    # a certain combination of shops actually provides all necessary parts
-    self.shops_have_part = {}
-    shops = sorted(self._shops.keys())
-    for p in self._parts_needed:
-      self.shops_have_part[p] = 0
-      for j in xrange(len(shops)):
-        if (shops[j] in [ s['shop_name'] for s in self._shops_for_parts[p] ]):
-          self.shops_have_part[p] += 1 << j
-    # loop over all possible shop combinations, comparing price
-    total = 2 ** FLAGS.consider_shops
-    Nprocs = FLAGS.jobs
-    pool = multiprocessing.Pool(processes=Nprocs)
-    # devide work into more than Nprocs parts to increase load balance
-    Nparts = Nprocs*10
-    results = [pool.apply_async(
-      MinimizePart, args=(self, total * k / Nparts, total * (k+1) / Nparts) )
-      for k in xrange(Nparts)]
+
+    def OnResult(result):
+      price, mask = result[:2]
+      if (mask is not None and price < best['price']):
+        best['price'] = price
+        best['mask'] = mask
+        self._Share(price, mask)
+      if len(result) > 2:
+        self._MergeCandidates(result[2])
+      if time.time() - last_checkpoint[0] >= CHECKPOINT_SECONDS:
+        self._WriteCheckpoint(checkpoint, ranges.Completed(), best['price'],
+                              best['mask'])
+        last_checkpoint[0] = time.time()
+
+    def Report(done, total, rate, seconds_left):
+      line = '\r%s %d%%, %d %s/s, ETA %s' % (
+          label, int(100 * done / total), rate, unit,
+          datetime.timedelta(seconds=int(seconds_left)))
+      if (best['mask'] is not None):
+        line += ', current best price: %.2f from %d shops.' % (
+            best['price'], bin(best['mask'] & all_shops).count('1'))
+      sys.stdout.write(line + '  ')
+      sys.stdout.flush()
+
+    if (FLAGS.jobs > 1):
+      pool = multiprocessing.Pool(processes=FLAGS.jobs,
+                                  initializer=InitWorker,
+                                  initargs=(self, incumbent, threshold))
+    else:
+      pool = None
+      InitWorker(self, incumbent, threshold)
+    def Stop():
+      # the frontier needs all combinations
+      return (target is not None and not TrackFrontier() and
+              best['price'] <= target)
+
     # catch KeyboardInterrupt to be able to abort 'cleanly' with Ctrl+C
-    best_price = 10**10
-    best_list = None
+    ranges = scheduler.RangeScheduler(pool, FLAGS.jobs, total, skip)
     try:
-      output = []
-      for p in results:
-        output.append(p.get(0xFFFFFFFF))
-        for _best_price, _best_list, _best_order in output:
-          if (_best_list and _best_price < best_price):
-            best_price = _best_price
-            best_list  = _best_list
-            self._order_bricks = _best_order
-        if (best_list):
-          sys.stdout.write('\rOptimizing... %d%%, current best price: %.2f from %d shops.  ' % (
-                           int(100*len(output)/len(results)), best_price, len(self._order_bricks)))
-        else:
-          sys.stdout.write('\rOptimizing... %d%%' % (
-                           int(100*len(output)/len(results))))
-        sys.stdout.flush()
+      finished = ranges.Run(RunWorkerTask, func, OnResult, Report, Stop)
     except KeyboardInterrupt:
-      return
+      if pool:
+        pool.terminate()
+      self._WriteCheckpoint(checkpoint, ranges.Completed(), best['price'],
+                            best['mask'])
+      print '\nInterrupted, continue with --resume from %s' % checkpoint
+      raise
+    finally:
+      if (best['mask'] is not None):
+        self._order_bricks = self._index.Order(best['mask'])
+    if os.path.exists(checkpoint):
+      os.remove(checkpoint)
+    # the repair of the minimum buy in PriceIndex.Allocate is greedy, it
+    # proves nothing
+    if (finished and best['mask'] is not None and
+        not self._index.min_buy_mask):
+      # the search skipped what can't beat the shared incumbent, which
+      # other processes may have found
+      self._proven_bound = best['price']
+      if incumbent is not None:
+        self._proven_bound = min(best['price'], incumbent.value)
+    if pool and not finished:
+      # the running chunks can't find anything that matters any more
+      pool.terminate()
+    elif pool:
+      pool.close()
+      pool.join()
     sys.stdout.write('\n')
 
 
-class GlpkSolver(OptimizerBase):
+"""
+Branch and bound search below the prefixes start..end-1 of include /
+exclude decisions, to be executed by one of possibly many processes. Bit d
+of a prefix tells whether the d-th shop of the branching order is taken,
+for the first self._bnb_prefix_depth shops; the prefixes are visited from
+all shops taken to none. The best price is shared through
+_worker_incumbent, so a better solution found by one worker immediately
+tightens the pruning in all others. With --alternatives, only subtrees that
+can't beat the alternatives either are pruned. Each process keeps its
+alternatives for all of its tasks, and the price they have to beat is
+shared through _worker_threshold: the alternatives of one worker are
+distinct combinations, so all workers need only beat the lowest price.
+"""
+def MinimizeBranch(self, start, end):
+  global _worker_candidates
+  best_price = 1.e10
+  best_mask = None
+  prefix_depth = self._bnb_prefix_depth
+  if _worker_candidates is None:
+    _worker_candidates = Candidates.Create(self._index, frontier=False)
+  candidates = _worker_candidates
+  for k in xrange(start, end):
+    price, mask = _SearchBranch(self, (1 << prefix_depth) - 1 - k,
+                                prefix_depth, candidates)
+    if mask is not None and price < best_price:
+      best_price = price
+      best_mask = mask
+  if candidates is not None:
+    return candidates.Result(best_price, best_mask, reprice=True)
+  return (best_price, best_mask)
+
+def _SearchBranch(self, prefix, prefix_depth, candidates=None):
+  order_offers = self._bnb_offers
+  suffix_min = self._bnb_suffix_min
+  partial = self._bnb_partial
+  num_shops = len(order_offers)
+  num_parts = len(suffix_min[0])
+  fix_cost = FLAGS.shop_fix_cost
+  if (self._max_shops is not None):
+    max_count = self._max_shops
+  else:
+    max_count = self._index.NumShops()
+
+  # best price of each part from the shops taken so far
+  current = [float('inf')] * num_parts
+  for r, price in self._bnb_forced_offers:
+    if price < current[r]:
+      current[r] = price
+  count = bin(self._index.forced_mask).count('1')
+  mask = 0
+  for d in xrange(prefix_depth):
+    if prefix & 1 << d:
+      for r, price in order_offers[d]:
+        if price < current[r]:
+          current[r] = price
+      count += 1
+      mask |= 1 << d
+  if count > max_count:
+    return (1.e10, None)
+
+  state = {'best_price': 1.e10, 'best_mask': None, 'nodes': 0,
+           'incumbent': _worker_incumbent.value,
+           'threshold': float('inf')}
+
+  def ShareThreshold():
+    state['threshold'] = candidates.threshold
+    if _worker_threshold is not None:
+      with _worker_threshold.get_lock():
+        if candidates.threshold < _worker_threshold.value:
+          _worker_threshold.value = candidates.threshold
+        state['threshold'] = _worker_threshold.value
+
+  if candidates is not None:
+    ShareThreshold()
+
+  def Record(price, mask):
+    # the price ignores the minimum buy and the quantity of the lots,
+    # which only add to it
+    if self._index.repair_mask:
+      i = IndexMask(mask)
+      if i & self._index.repair_mask:
+        price = self._index.TotalCost(i, fix_cost)
+        if price is None or price >= state['incumbent']:
+          return
+    state['best_price'] = price
+    state['best_mask'] = mask
+    with _worker_incumbent.get_lock():
+      if price < _worker_incumbent.value:
+        _worker_incumbent.value = price
+      state['incumbent'] = _worker_incumbent.value
+
+  # with --target_gap, subtrees that can't be much cheaper are skipped
+  keep = 1 - FLAGS.target_gap
+
+  def IndexMask(mask):
+    i = sum(self._bnb_key_bits[d] for d in xrange(num_shops) if mask & 1 << d)
+    return i | self._index.forced_mask
+
+  def Search(depth, count, mask):
+    state['nodes'] += 1
+    if not state['nodes'] & 0xff:
+      state['incumbent'] = min(state['incumbent'], _worker_incumbent.value)
+      if candidates is not None:
+        ShareThreshold()
+    remaining = suffix_min[depth]
+    price = count * fix_cost
+    bound = price
+    for r in xrange(num_parts):
+      c = current[r]
+      price += c
+      if c < remaining[r]:
+        bound += c
+      else:
+        bound += remaining[r]
+    # The shops taken so far are a solution on their own if they have
+    # every part, this is the same as leaving out all remaining shops.
+    if price < state['incumbent']:
+      Record(price, mask)
+    cutoff = state['incumbent']
+    if candidates is not None:
+      # leaving out a shop doesn't change the combination, it's only new
+      # in the root and after taking a shop
+      if (price < candidates.threshold and
+          (depth == prefix_depth or mask & 1 << depth - 1)):
+        candidates.Add(price, IndexMask(mask), count)
+        ShareThreshold()
+      cutoff = max(cutoff, state['threshold'])
+    if (depth == num_shops or count >= max_count or
+        bound >= cutoff * keep):
+      return
+    # Take the shop. A shop that is not cheaper for any part can't be part
+    # of a better solution, unless a lot of one of its parts is too small
+    # and it's needed for the quantity.
+    changed = []
+    for r, c in order_offers[depth]:
+      if c < current[r]:
+        changed.append((r, current[r]))
+        current[r] = c
+    if changed or partial[depth]:
+      Search(depth + 1, count + 1, mask | 1 << depth)
+      for r, c in changed:
+        current[r] = c
+    # Leave out the shop.
+    Search(depth + 1, count, mask)
+
+  Search(prefix_depth, count, mask)
+  if state['best_mask'] is None:
+    return (1.e10, None)
+  i = IndexMask(state['best_mask'])
+  return (self._index.TotalCost(i, FLAGS.shop_fix_cost), i)
+
+class BnbOptimizer(BuiltinOptimizer):
+  def _PrepareBranching(self):
+    index = self._index
+    # Branch on the shops that are the cheapest source of many parts first,
+    # they are the most likely to be in a good solution early.
+    cheapest_for = [0] * index.NumShops()
+    for offers in index.part_offers:
+      if offers:
+        cheapest_for[offers[0][0]] += 1
+    order = sorted(xrange(index.NumFreeShops()),
+                   key=lambda j: (-cheapest_for[j],
+                                  -len(index.shop_offers[j]), j))
+
+    # [[(part index, price of the needed quantity)]] in branching order
+    self._bnb_offers = [
+        [(i, price * index.demand[i]) for i, price in index.shop_offers[j]]
+        for j in order]
+    # suffix_min[d][r]: cheapest price of part r from shops d and later
+    suffix_min = [[float('inf')] * index.NumParts()]
+    for d in xrange(len(order) - 1, -1, -1):
+      row = list(suffix_min[0])
+      for r, price in self._bnb_offers[d]:
+        if price < row[r]:
+          row[r] = price
+      suffix_min.insert(0, row)
+    self._bnb_suffix_min = suffix_min
+    self._bnb_key_bits = [1 << j for j in order]
+    # whether each shop offers a part of which some lot is too small
+    self._bnb_partial = [
+        bool(index.shop_parts[j] & index.partial_parts) for j in order]
+    # [(part index, price of the needed quantity)] of all forced shops
+    self._bnb_forced_offers = [
+        (i, price * index.demand[i])
+        for j in xrange(index.NumFreeShops(), index.NumShops())
+        for i, price in index.shop_offers[j]]
+
+  def Solve(self):
+    self._PrepareBranching()
+    num_shops = len(self._bnb_offers)
+
+    # The critical shops have every part, that is a good first incumbent.
+    critical = self._index.ShopMask(self._critical_shops)
+    best_price, best_mask = MinimizePart(self, critical, critical + 1)[:2]
+    if best_mask is not None:
+      self._order_bricks = self._index.Order(best_mask)
+
+    incumbent = self._Incumbent(best_price)
+    # split the top of the search tree into enough subtrees to keep all
+    # processes busy
+    self._bnb_prefix_depth = 0
+    while (self._bnb_prefix_depth < num_shops and
+           1 << self._bnb_prefix_depth < FLAGS.jobs * 16 and FLAGS.jobs > 1):
+      self._bnb_prefix_depth += 1
+    threshold = None
+    if FLAGS.alternatives:
+      threshold = multiprocessing.Value('d', float('inf'))
+    self._Schedule('Optimizing with branch and bound...', 'subtrees',
+                   MinimizeBranch, 1 << self._bnb_prefix_depth,
+                   best_price, best_mask, incumbent, threshold)
+    # the pruning only proves that nothing is cheaper by more than the gap
+    if self._proven_bound is not None:
+      self._proven_bound *= 1 - FLAGS.target_gap
+
+
+"""
+Combines the subsets start..end-1 of the first half of the free shops with
+the subsets of the second half, to be executed by one of possibly many
+processes. Both lists are sorted by their lower bound, so the pairs of one
+subset of the first half can be stopped at the first one whose bound
+doesn't beat the best price, which is shared through _worker_incumbent.
+"""
+def MinimizeHalves(self, start, end):
+  index = self._index
+  first = self._mitm_first
+  second = self._mitm_second
+  overlap = self._mitm_overlap
+  part_offers = self._mitm_part_offers
+  fix_cost = FLAGS.shop_fix_cost
+  forced = index.forced_mask
+  num_forced = bin(forced).count('1')
+  if (self._max_shops is not None):
+    max_count = self._max_shops - num_forced
+  else:
+    max_count = index.NumShops()
+  keep = 1 - FLAGS.target_gap
 
+  best_price = 1.e10
+  best_mask = None
+  for bound_a, mask_a, count_a in first[start:end]:
+    incumbent = _worker_incumbent.value * keep
+    if bound_a + second[0][0] - overlap >= incumbent:
+      break
+    for bound_b, mask_b, count_b in second:
+      if bound_a + bound_b - overlap >= incumbent:
+        break
+      if count_a + count_b > max_count:
+        continue
+      mask = mask_a | mask_b | forced
+      # the price of the pair, given up as soon as it is too high
+      price = (count_a + count_b + num_forced) * fix_cost
+      for offers in part_offers:
+        for bit, part_price in offers:
+          if mask & bit:
+            price += part_price
+            break
+        else:
+          break
+        if price >= incumbent:
+          break
+      else:
+        # the price ignores the minimum buy and the quantity of the lots,
+        # which only add to it
+        if mask & index.repair_mask:
+          price = index.TotalCost(mask, fix_cost)
+          if price is None or price >= incumbent:
+            continue
+        best_price = price
+        best_mask = mask
+        with _worker_incumbent.get_lock():
+          if price < _worker_incumbent.value:
+            _worker_incumbent.value = price
+          incumbent = _worker_incumbent.value * keep
+  return (best_price, best_mask)
+
+class MitmOptimizer(BuiltinOptimizer):
+  """
+  Meet in the middle: the free shops are split into two halves and the
+  subsets of each half are enumerated on their own, about 2 * 2**(n/2)
+  subsets instead of 2**n. A pair of subsets costs at least the sum of
+  their bounds minus the overlap, see _Half, and the pairs are only
+  combined as long as that can beat the best price.
+  """
+
+  def _Half(self, half, other_best):
+    """
+    Returns [(lower bound, shop mask, number of shops)] of the subsets of
+    the shops in half that may be part of an optimal solution, sorted by
+    the bound. The bound is the fix cost of the subset's shops and the
+    price of every part from the subset, the forced shops or any shop of
+    the other half, whichever is cheapest. other_best is the price of each
+    part from the forced shops and the other half.
+
+    A subset in which a shop is not the cheapest source of any part is
+    skipped together with all its supersets, the subset without that shop
+    is always cheaper. Not so if a lot of one of its parts is too small,
+    the shop may be needed for the quantity.
+    """
+    index = self._index
+    offers = self._mitm_offers
+    partial = [bool(index.shop_parts[j] & index.partial_parts)
+               for j in xrange(index.NumShops())]
+    fix_cost = FLAGS.shop_fix_cost
+    if (self._max_shops is not None):
+      max_count = self._max_shops - bin(index.forced_mask).count('1')
+    else:
+      max_count = len(half)
+    current = list(self._mitm_forced)
+    # the shop of the subset each part is bought from, None for the forced
+    # shops, and the number of parts each shop of the half is the source of
+    source = [None] * index.NumParts()
+    sources = [0] * len(half)
+    inf = float('inf')
+    bound = 0.0
+    # parts that neither the subset nor the other half offer
+    missing = 0
+    for i in xrange(index.NumParts()):
+      price = min(current[i], other_best[i])
+      if price == inf:
+        missing += 1
+      else:
+        bound += price
+    result = []
+
+    def Visit(start, count, mask, bound, missing):
+      if not missing:
+        result.append((bound + count * fix_cost, mask, count))
+      if count >= max_count:
+        return
+      for k in xrange(start, len(half)):
+        changed = []
+        delta = 0.0
+        lost = missing
+        useless = False
+        for i, price in offers[half[k]]:
+          c = current[i]
+          if price < c:
+            changed.append((i, c, source[i]))
+            other = other_best[i]
+            if price < other:
+              if c < other:
+                delta += price - c
+              elif other == inf:
+                delta += price
+                lost -= 1
+              else:
+                delta += price - other
+            current[i] = price
+            if source[i] is not None:
+              sources[source[i]] -= 1
+              if not sources[source[i]] and not partial[half[source[i]]]:
+                useless = True
+            source[i] = k
+        sources[k] = len(changed)
+        if (changed or partial[half[k]]) and not useless:
+          Visit(k + 1, count + 1, mask | 1 << half[k], bound + delta, lost)
+        for i, c, s in changed:
+          current[i] = c
+          source[i] = s
+          if s is not None:
+            sources[s] += 1
+        sources[k] = 0
+
+    Visit(0, 0, 0, bound, missing)
+    result.sort()
+    return result
+
+  def Solve(self):
+    index = self._index
+    if not index.HasAllParts((1 << index.NumShops()) - 1):
+      return
+    inf = float('inf')
+    # [[(part index, price of the needed quantity)]] of every shop
+    self._mitm_offers = [
+        [(i, price * index.demand[i]) for i, price in index.shop_offers[j]]
+        for j in xrange(index.NumShops())]
+    # [[(shop bit, price of the needed quantity)]] of every part, cheapest
+    # first
+    self._mitm_part_offers = [
+        [(1 << j, price * index.demand[i]) for j, price in index.part_offers[i]]
+        for i in xrange(index.NumParts())]
+    self._mitm_forced = [inf] * index.NumParts()
+    for j in xrange(index.NumFreeShops(), index.NumShops()):
+      for i, price in self._mitm_offers[j]:
+        self._mitm_forced[i] = min(self._mitm_forced[i], price)
+
+    # Deal the shops that are the cheapest source of many parts to both
+    # halves alike, so that both prune about as well.
+    cheapest_for = [0] * index.NumShops()
+    for offers in index.part_offers:
+      if offers:
+        cheapest_for[offers[0][0]] += 1
+    order = sorted(xrange(index.NumFreeShops()),
+                   key=lambda j: (-cheapest_for[j],
+                                  -len(index.shop_offers[j]), j))
+    halves = (order[0::2], order[1::2])
+    # best[h][i]: price of part i from the forced shops and all of half h
+    best = []
+    for half in halves:
+      row = list(self._mitm_forced)
+      for j in half:
+        for i, price in self._mitm_offers[j]:
+          row[i] = min(row[i], price)
+      best.append(row)
+    self._mitm_overlap = sum(min(a, b) for a, b in zip(best[0], best[1]))
+
+    self._mitm_first = self._Half(halves[0], best[1])
+    self._mitm_second = self._Half(halves[1], best[0])
+    print ('Meet in the middle: %d and %d subsets of the two halves of %d '
+           'shops are worth combining.' % (
+               len(self._mitm_first), len(self._mitm_second),
+               index.NumFreeShops()))
+    if not self._mitm_first or not self._mitm_second:
+      return
+
+    # The critical shops have every part, that is a good first incumbent.
+    critical = index.ShopMask(self._critical_shops)
+    best_price, best_mask = MinimizePart(self, critical, critical + 1)[:2]
+    incumbent = self._Incumbent(best_price)
+    self._Schedule('Combining the halves...', 'subsets', MinimizeHalves,
+                   len(self._mitm_first), best_price, best_mask, incumbent)
+    # the pruning only proves that nothing is cheaper by more than the gap
+    if self._proven_bound is not None:
+      self._proven_bound *= 1 - FLAGS.target_gap
+
+
+"""
+Local search from the seeds start..end-1, until --time_budget seconds
+after the start of HeuristicOptimizer.Solve. Every improvement of the best
+price of all processes, shared through _worker_incumbent, is printed.
+"""
+def MinimizeHeuristic(self, start, end):
+  start_time = self._search_start
+
+  def Report(price, mask):
+    with _worker_incumbent.get_lock():
+      if price >= _worker_incumbent.value:
+        return
+      _worker_incumbent.value = price
+      for j in xrange(len(_worker_best_shops)):
+        _worker_best_shops[j] = mask >> j & 1
+    self._Share(price, mask)
+    # one write, so that the lines of the processes don't mix
+    sys.stdout.write('%6.1fs: best price %.2f from %d shops.\n' % (
+        time.time() - start_time, price, bin(mask).count('1')))
+    sys.stdout.flush()
+
+  best_price = 1.e10
+  best_mask = None
+  for seed in xrange(start, end):
+    price, mask = heuristic.Search(
+        self._index, FLAGS.shop_fix_cost, start_time + FLAGS.time_budget,
+        seed, Report, self._search_target)
+    if mask is not None and price < best_price:
+      best_price = price
+      best_mask = mask
+  return (best_price, best_mask)
+
+class HeuristicOptimizer(OptimizerBase):
   def Run(self):
-    hash_str = str(self._parts_needed) + str(self._shops_for_parts)
-    file_prefix = '%s/%s.%08x' % (
+    # --time_budget is for all parts together. Opening or closing a shop
+    # doesn't change the cost of independent groups of parts anyway, so
+    # there is nothing to gain from solving them one by one.
+    self.Solve()
+
+  def Solve(self):
+    print 'Optimizing with local search for %g seconds...' % FLAGS.time_budget
+    self._search_start = time.time()
+    # stop as soon as a solution is within --target_gap of the lower bound
+    self._search_target = None
+    bound = self.LowerBound()
+    if bound is not None:
+      print 'Lower bound: %.2f' % bound
+      self._search_target = bound / (1 - FLAGS.target_gap) + 1e-9
+    incumbent = self._Incumbent(1.e10)
+    best_shops = multiprocessing.Array('b', self._index.NumShops())
+    # each process searches from its own random seed
+    try:
+      if (FLAGS.jobs > 1):
+        pool = multiprocessing.Pool(processes=FLAGS.jobs,
+                                    initializer=InitWorker,
+                                    initargs=(self, incumbent, None,
+                                              best_shops))
+        tasks = [pool.apply_async(RunWorkerTask,
+                                  (MinimizeHeuristic, seed, seed + 1))
+                 for seed in xrange(FLAGS.jobs)]
+        try:
+          results = [task.get(0xFFFFFFFF) for task in tasks]
+        except KeyboardInterrupt:
+          pool.terminate()
+          raise
+        pool.close()
+        pool.join()
+      else:
+        InitWorker(self, incumbent, None, best_shops)
+        results = [MinimizeHeuristic(self, 0, 1)]
+    except KeyboardInterrupt:
+      mask = sum(1 << j for j in xrange(len(best_shops)) if best_shops[j])
+      if mask:
+        self._order_bricks = self._index.Order(mask) or {}
+      raise
+    best_price, best_mask = min(results, key=lambda result: result[0])
+    if best_mask is not None:
+      self._order_bricks = self._index.Order(best_mask)
+
+
+class GlpkSolver(OptimizerBase):
+
+  def Solve(self):
+    # ModelHash() also covers the fix cost, which changes the solution
+    file_prefix = '%s/%s.%s' % (
         FLAGS.cachedir,
         os.path.splitext(os.path.basename(self._ldd_file_name))[0],
-        hash(hash_str) & 0xffffffff)
+        self.ModelHash())
     ampl_file_name = '%s.ampl' % file_prefix
-    solution_file_name = '%s.solution' % file_prefix
+    solution_file_name = '%s.sol' % file_prefix
     
     if FLAGS.rerun_solver:
       print 'Forced rerun of solver for solution file %s' % solution_file_name
-      self._RunSolver(ampl_file_name, solution_file_name)
-    elif os.path.exists(solution_file_name):
+    elif self._ReadSolution(solution_file_name):
       print 'Using cached solution file %s' % solution_file_name
+      return
+    elif os.path.exists(solution_file_name):
+      print 'Cached solution file %s is incomplete, running solver' % (
+          solution_file_name)
     else:
       print 'Cached solution file %s not found, running solver' % (
           solution_file_name)
-      try:
-        os.makedirs(FLAGS.cachedir)
-      except OSError:
-        pass
-      self._RunSolver(ampl_file_name, solution_file_name)
     try:
-      solution_file = open(solution_file_name, 'r')
-      self._Parse(solution_file)
+      os.makedirs(FLAGS.cachedir)
+    except OSError:
+      pass
+    self._RunSolver(ampl_file_name, solution_file_name)
+    if not self._ReadSolution(solution_file_name):
+      print 'glpsol did not finish with a solution, see its messages above.'
+
+  def _ReadSolution(self, solution_file_name):
+    """Parses the solution file, False if it is missing or incomplete."""
+    if not os.path.exists(solution_file_name):
+      return False
+    solution_file = open(solution_file_name, 'r')
+    try:
+      return self._Parse(solution_file)
     finally:
       solution_file.close()
 
   def _RunSolver(self, ampl_file_name, solution_file_name):
+    # glpsol only writes the solution file once it has a solution
+    if os.path.exists(solution_file_name):
+      os.remove(solution_file_name)
+    warm_start = self._WarmStart()
+    if warm_start is not None and warm_start[2]:
+      # the gap it has, which may be less than --target_gap
+      gap = max(0.0, 1 - self.LowerBound() / warm_start[0])
+      self._WriteSolution(solution_file_name, warm_start[1], 'optimal', gap)
+      return
+    ampl_file = open(ampl_file_name, 'w')
     try:
-      ampl_file = open(ampl_file_name, 'w')
-      self._Output(ampl_file)
-      ampl_file.flush()
-      args = ['glpsol', '--model', ampl_file.name,
-              '--output', solution_file_name]
-      if (FLAGS.glpk_limit_seconds):
-        args.extend(['--tmlim', str(FLAGS.glpk_limit_seconds)])
-      subprocess.call(args)
+      cutoff = None
+      if warm_start is not None:
+        cutoff = warm_start[0] * (1 + 1e-6) + 0.01
+      self._Output(ampl_file, solution_file_name, cutoff)
     finally:
       ampl_file.close()
+    args = ['glpsol', '--model', ampl_file_name]
+    if (FLAGS.glpk_limit_seconds):
+      args.extend(['--tmlim', str(FLAGS.glpk_limit_seconds)])
+    if (FLAGS.target_gap):
+      args.extend(['--mipgap', str(FLAGS.target_gap)])
+    # The solution file doesn't tell whether the solution is optimal, only
+    # the messages of glpsol do. They are passed through as they come.
+    status = None
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, ''):
+      sys.stdout.write(line)
+      sys.stdout.flush()
+      if line.startswith('INTEGER OPTIMAL SOLUTION FOUND'):
+        status = 'optimal'
+      elif 'NO INTEGER FEASIBLE SOLUTION' in line:
+        status = 'infeasible'
+    returncode = process.wait()
+    # Stopped by --tmlim, the orders it wrote are a solution if there are
+    # any. Without an integer solution glpsol writes none or no file.
+    found = (os.path.exists(solution_file_name) and
+             os.path.getsize(solution_file_name) > 0)
+    if returncode:
+      print 'glpsol failed with exit code %d.' % returncode
+      status = 'failed'
+    elif status is None:
+      status = 'feasible' if found else 'failed'
+    if warm_start is not None and status == 'failed' and not returncode:
+      print 'glpk found no solution in time, using the warm start solution.'
+      self._WriteSolution(solution_file_name, warm_start[1], 'feasible')
+      return
+    if status == 'failed':
+      # anything glpsol wrote before it failed is no solution
+      solution_file = open(solution_file_name, 'w')
+    else:
+      solution_file = open(solution_file_name, 'a')
+    try:
+      if status == 'optimal':
+        # glpsol proved it within --mipgap
+        solution_file.write('end optimal %r\n' % FLAGS.target_gap)
+      else:
+        solution_file.write('end %s\n' % status)
+    finally:
+      solution_file.close()
+
+  def _WriteSolution(self, solution_file_name, mask, status, gap=None):
+    """
+    Writes the solution file of glpsol for the shops in mask, with the gap
+    to the lower bound that is proven for it, if any.
+    """
+    index = self._index
+    solution_file = open(solution_file_name, 'w')
+    try:
+      for (i, j), quantity in sorted(index.Allocate(mask)[1].iteritems()):
+        solution_file.write('%s %s %d\n' % (
+            index.parts[i], index.shops[j], quantity))
+      if gap is None:
+        solution_file.write('end %s\n' % status)
+      else:
+        solution_file.write('end %s %r\n' % (status, gap))
+    finally:
+      solution_file.close()
 
   def _Parse(self, f):
-    self._order_bricks = {}
-    shop_re = re.compile(r'order_shop\[(.*)\]')
-    brick_re = re.compile(r'order_brick\[(.*),(.*)\]')
-    qty_re = re.compile(r'\A +\* +([0-9]+) +')
+    """
+    Reads the orders from the solution file, a line "brick shop quantity"
+    for each order and a last line "end status", "end optimal gap" for a
+    solution within gap of the lower bound. The gap is that of the run that
+    wrote the file, not the current --target_gap. Returns False if that is
+    missing or says that glpsol failed.
+    """
+    index = self._index
+    quantities = {}
+    status = None
+    gap = None
     for line in f:
-      shop_match = shop_re.search(line)
-      if shop_match:
-        shop_name = GlpkSolver._TrimQuotes(shop_match.group(1))
-        continue
-      brick_match = brick_re.search(line)
-      if brick_match:
-        brick = item.item(brick_match.group(1))
-        shop_name = GlpkSolver._TrimQuotes(brick_match.group(2))
-        continue
-      qty_match = qty_re.match(line)
-      if qty_match:
-        qty = int(qty_match.group(1))
-        if qty:
-          if brick:
-            self._order_bricks.setdefault(shop_name, {})[brick] = int(qty)
-        continue
-      shop_name = None
-      brick = None
-
-  def _Output(self, f):
+      if line.startswith('end '):
+        fields = line.split()
+        status = fields[1]
+        if len(fields) > 2:
+          gap = float(fields[2])
+        break
+      # shop names may contain spaces
+      brick, line = line.split(' ', 1)
+      shop_name, qty = line.rsplit(' ', 1)
+      # a brick of the model may stand for a group of merged parts
+      i = index.part_ids[item.item(GlpkSolver._TrimQuotes(brick))]
+      j = index.shop_ids[GlpkSolver._TrimQuotes(shop_name)]
+      quantities[(i, j)] = quantities.get((i, j), 0) + int(qty)
+    self._order_bricks = index.SplitQuantities(quantities)
+    if status != 'feasible' and status != 'optimal':
+      self._order_bricks = {}
+    if status == 'optimal' and gap is not None and self._order_bricks:
+      self._proven_bound = self.GrossGrandTotal() * (1 - gap)
+    return status is not None and status != 'failed'
+
+  def _Output(self, f, solution_file_name, cutoff=None):
+    """
+    Writes the model and its data record by record, with a constraint on
+    the cost if cutoff is not None.
+    """
     f.write(AMPL_MODEL)
-    f.write('set Bricks\n%s;\n\n' % '\n'.join(self._parts_needed.keys()))
-    f.write('set Shops\n%s;\n\n' % '\n'.join(self._shops.keys()))
-    f.write('param fix_cost :=\n%s;\n\n' % '\n'.join(
-        '%s %.5f' % (s, FLAGS.shop_fix_cost) for s in self._shops))
-    f.write('param min_order :=\n%s;\n\n' % '\n'.join(
-        '%s %.5f' % (s, self._shops[s]['min_buy']) for s in self._shops))
-    f.write('param demand :=\n%s;\n\n' % '\n'.join(
-        '%s %d' % (p, self._parts_needed[p]) for p in self._parts_needed))
-    f.write('param unit_price : %s :=\n' % ' '.join(p for p in self._shops))
-    for p in self._shops_for_parts:
-      f.write('%s' % p)
-      for s in self._shops:
-        if s in set(s['shop_name'] for s in self._shops_for_parts[p]):
-          l = [o['unit_price']
-               for o in self._shops_for_parts[p] if o['shop_name'] == s]
-          f.write(' %.5f' % l[0])
-        else:
-          f.write(' %.5f' % AMPL_UNAVAILABLE_PRICE)
-      f.write('\n')
-    f.write(';\n\n')
+    if cutoff is not None:
+      f.write(AMPL_CUTOFF % {'cutoff': cutoff})
+    f.write(AMPL_SOLUTION % {
+        'file': solution_file_name.replace('"', '""')})
+    index = self._index
+    offers = self._Offers()
+    GlpkSolver._WriteData(f, 'set Bricks', index.parts)
+    GlpkSolver._WriteData(f, 'set Shops', index.shops)
+    GlpkSolver._WriteData(f, 'param fix_cost :=', (
+        '%s %.5f' % (s, FLAGS.shop_fix_cost) for s in index.shops))
+    GlpkSolver._WriteData(f, 'param min_order :=', (
+        '%s %.5f' % (s, self._shops[s]['min_buy']) for s in index.shops))
+    GlpkSolver._WriteData(f, 'param demand :=', (
+        '%s %d' % (index.parts[i], index.demand[i])
+        for i in xrange(index.NumParts())))
+    GlpkSolver._WriteData(f, 'set Offers :=', (
+        '%s %s' % (index.parts[i], index.shops[j])
+        for i, j, price, max_bricks in offers))
+    GlpkSolver._WriteData(f, 'param unit_price :=', (
+        '%s %s %.5f' % (index.parts[i], index.shops[j], price)
+        for i, j, price, max_bricks in offers))
+    GlpkSolver._WriteData(f, 'param max_bricks :=', (
+        '%s %s %d' % (index.parts[i], index.shops[j], max_bricks)
+        for i, j, price, max_bricks in offers))
     f.write('end;\n')
 
+  @staticmethod
+  def _WriteData(f, header, records):
+    f.write('%s\n' % header)
+    for record in records:
+      f.write('%s\n' % record)
+    f.write(';\n\n')
+
   @staticmethod
   def _TrimQuotes(s):
     if s.startswith("'") and s.endswith("'"):
@@ -688,10 +2345,709 @@ class GlpkSolver(OptimizerBase):
     else:
 	  return s
 
+class HighsSolver(OptimizerBase):
+  """
+  Solves the model of AMPL_MODEL with the external highs program of HiGHS,
+  from a model file in CPLEX LP format in --cachedir. It only has variables
+  for the offers that exist, instead of a dense price table.
+  """
+
+  def Solve(self):
+    index = self._index
+    warm_start = self._WarmStart()
+    if warm_start is not None and warm_start[2]:
+      self._order_bricks = index.Order(warm_start[1])
+      return
+    file_prefix = '%s/%s.%s' % (
+        FLAGS.cachedir,
+        os.path.splitext(os.path.basename(self._ldd_file_name))[0],
+        self.ModelHash())
+    lp_file_name = '%s.lp' % file_prefix
+    options_file_name = '%s.highs.options' % file_prefix
+    start_file_name = '%s.highs.start' % file_prefix
+    solution_file_name = '%s.highs.sol' % file_prefix
+    try:
+      os.makedirs(FLAGS.cachedir)
+    except OSError:
+      pass
+    offers = self._Offers()
+    lp_file = open(lp_file_name, 'w')
+    try:
+      self._Output(lp_file, offers)
+    finally:
+      lp_file.close()
+    options_file = open(options_file_name, 'w')
+    try:
+      options_file.write('threads = %d\n' % FLAGS.jobs)
+      if (FLAGS.glpk_limit_seconds):
+        options_file.write('time_limit = %d\n' % FLAGS.glpk_limit_seconds)
+      if (FLAGS.target_gap):
+        options_file.write('mip_rel_gap = %r\n' % FLAGS.target_gap)
+    finally:
+      options_file.close()
+    args = ['highs', '--model_file', lp_file_name,
+            '--options_file', options_file_name,
+            '--solution_file', solution_file_name]
+    if warm_start is not None:
+      self._WriteStart(start_file_name, offers, warm_start[1])
+      args.extend(['--read_solution_file', start_file_name])
+    # highs only writes the solution file at the end
+    if os.path.exists(solution_file_name):
+      os.remove(solution_file_name)
+
+    print 'Optimizing with HiGHS, %d shops, %d offers...' % (
+        index.NumShops(), len(offers))
+    sys.stdout.flush()
+    # The solution file doesn't have the lower bound, only the messages of
+    # highs do. They are passed through as they come.
+    dual_bound = None
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, ''):
+      sys.stdout.write(line)
+      sys.stdout.flush()
+      match = re.match(r'\s*Dual bound\s+(\S+)', line)
+      if match:
+        dual_bound = float(match.group(1))
+    returncode = process.wait()
+
+    self._order_bricks = {}
+    model_status, values = None, None
+    if os.path.exists(solution_file_name):
+      solution_file = open(solution_file_name, 'r')
+      try:
+        model_status, values = HighsSolver._Parse(solution_file)
+      finally:
+        solution_file.close()
+    if values is None:
+      if returncode:
+        print 'highs failed with exit code %d.' % returncode
+      else:
+        print 'HiGHS found no solution: %s' % model_status
+      if warm_start is not None:
+        print 'Using the warm start solution.'
+        self._order_bricks = index.Order(warm_start[1])
+      return
+    quantities = {}
+    for o, (i, j, price, max_bricks) in enumerate(offers):
+      qty = int(round(values.get('b%d' % o, 0.0)))
+      if qty:
+        quantities[(i, j)] = qty
+    # a part of the model may stand for a group of merged parts
+    self._order_bricks = index.SplitQuantities(quantities)
+    if model_status == 'Optimal':
+      self._proven_bound = dual_bound
+    else:
+      print 'HiGHS stopped early: %s' % model_status
+
+  def _Output(self, f, offers):
+    """
+    Writes the model in CPLEX LP format. Shop j is the binary variable s<j>,
+    offer o of offers the integer variable b<o>.
+    """
+    index = self._index
+    min_buy = [self._shops[s]['min_buy'] for s in index.shops]
+    f.write('Minimize\n cost:\n')
+    for j in xrange(index.NumShops()):
+      f.write(' + %.5f s%d\n' % (FLAGS.shop_fix_cost, j))
+    for o, (i, j, price, max_bricks) in enumerate(offers):
+      f.write(' + %.5f b%d\n' % (price, o))
+    f.write('Subject To\n')
+    part_offers = [[] for i in xrange(index.NumParts())]
+    shop_offers = [[] for j in xrange(index.NumShops())]
+    for o, (i, j, price, max_bricks) in enumerate(offers):
+      part_offers[i].append(o)
+      shop_offers[j].append(o)
+    for i in xrange(index.NumParts()):
+      terms = ''.join(' + b%d' % o for o in part_offers[i])
+      f.write(' brick_at_least%d:%s >= %d\n' % (i, terms, index.demand[i]))
+      f.write(' brick_not_too_much%d:%s <= %d\n' % (
+          i, terms, 10 * index.demand[i]))
+    for o, (i, j, price, max_bricks) in enumerate(offers):
+      f.write(' brick_shop_sync%d: b%d - %d s%d <= 0\n' % (
+          o, o, max_bricks, j))
+    for j in xrange(index.NumShops()):
+      if min_buy[j] > 0:
+        f.write(' shop_at_least%d:%s - %.5f s%d >= 0\n' % (
+            j, ''.join(' + %.5f b%d' % (offers[o][2], o)
+                       for o in shop_offers[j]),
+            min_buy[j], j))
+    f.write('Bounds\n')
+    for j in xrange(index.NumShops()):
+      # the shops that presolve fixed are always ordered from
+      f.write(' %d <= s%d <= 1\n' % (int(j >= index.NumFreeShops()), j))
+    for o, (i, j, price, max_bricks) in enumerate(offers):
+      f.write(' 0 <= b%d <= %d\n' % (o, max_bricks))
+    f.write('General\n')
+    for j in xrange(index.NumShops()):
+      f.write(' s%d\n' % j)
+    for o in xrange(len(offers)):
+      f.write(' b%d\n' % o)
+    f.write('End\n')
+
+  def _WriteStart(self, start_file_name, offers, mask):
+    """Writes the orders of the shops in mask as a solution file of highs."""
+    quantities = self._index.Allocate(mask)[1]
+    used = set(j for i, j in quantities)
+    start_file = open(start_file_name, 'w')
+    try:
+      start_file.write('Model status\nNot Set\n\n# Primal solution values\n'
+                       'Feasible\nObjective 0\n# Columns %d\n' % (
+                           self._index.NumShops() + len(offers)))
+      for j in xrange(self._index.NumShops()):
+        start_file.write('s%d %d\n' % (j, int(j in used)))
+      for o, (i, j, price, max_bricks) in enumerate(offers):
+        start_file.write('b%d %d\n' % (o, quantities.get((i, j), 0)))
+    finally:
+      start_file.close()
+
+  @staticmethod
+  def _Parse(f):
+    """
+    Reads a solution file of highs. Returns (model status, {column name:
+    value}), the values None unless the file has a feasible solution.
+    """
+    lines = [line.strip() for line in f]
+    model_status = None
+    if 'Model status' in lines:
+      model_status = lines[lines.index('Model status') + 1]
+    if '# Primal solution values' not in lines:
+      return (model_status, None)
+    k = lines.index('# Primal solution values') + 1
+    if lines[k] != 'Feasible':
+      return (model_status, None)
+    while not lines[k].startswith('# Columns'):
+      k += 1
+    values = {}
+    for line in lines[k + 1:k + 1 + int(lines[k].split()[2])]:
+      name, value = line.split()
+      values[name] = float(value)
+    return (model_status, values)
+
+
+def StartProcessGroup(process):
+  """
+  Starts the multiprocessing.Process process as the leader of a process
+  group of its own, which StopProcessGroup() stops with all the processes
+  it started. The process calls os.setpgrp() itself as well, so that the
+  group exists before it starts any, whichever of both comes first.
+  """
+  process.start()
+  try:
+    os.setpgid(process.pid, process.pid)
+  except OSError:
+    # it has already exited
+    pass
+
+def StopProcessGroup(process):
+  """Stops the process started by StartProcessGroup(), if it still runs."""
+  if process.pid is None:
+    return
+  if process.is_alive():
+    try:
+      os.killpg(process.pid, signal.SIGTERM)
+    except OSError:
+      process.terminate()
+  process.join()
+
+"""
+The best price of all variants of a portfolio, for pruning. It is set by
+the portfolio process when it receives a better solution.
+"""
+_variant_incumbent = None
+
+def RunVariant(portfolio, variant, queue, incumbent):
+  """
+  Runs a variant of the portfolio in a process of its own, on a copy of the
+  loaded model. Sends ('better', variant, price, mask) for solutions found
+  on the way, then ('done', variant, price, orders, proven lower bound) or
+  ('failed', variant, message).
+  """
+  global _variant_incumbent
+  _variant_incumbent = incumbent
+  # a process group of its own, so that the portfolio can stop the variant
+  # together with its worker processes and solvers
+  os.setpgrp()
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    mode, overrides = ParseVariant(FLAGS.portfolio[variant])
+    FLAGS.jobs = 1
+    for name, value in overrides:
+      FLAGS[name].Parse(value)
+    FLAGS.mode = mode
+    optimizer = CreateOptimizer()
+    optimizer.__dict__.update(portfolio.__dict__)
+    optimizer._max_shops = optimizer._MaxShops()
+    optimizer._portfolio = (queue, variant)
+    optimizer.Run()
+  except Exception, e:
+    queue.put(('failed', variant, str(e)))
+    return
+  # A proof under --max_shops says nothing about solutions with more shops,
+  # which other variants may find; the relaxation bound holds for all.
+  if optimizer._max_shops is not None:
+    optimizer._proven_bound = None
+  if optimizer.Orders() is None:
+    queue.put(('done', variant, 1.e10, None, optimizer._proven_bound))
+  else:
+    queue.put(('done', variant, optimizer.GrossGrandTotal(),
+               optimizer.Orders(), optimizer.LowerBound()))
+
+def ParseVariant(spec, flag='portfolio'):
+  """
+  Splits 'mode:flag=value:...' into (mode, [(flag, value)]), flag names
+  the list of variants it is from for the errors.
+  """
+  fields = spec.split(':')
+  overrides = []
+  for field in fields[1:]:
+    if '=' not in field:
+      raise NameError('Expected flag=value in --%s variant %s' % (flag, spec))
+    name, value = field.split('=', 1)
+    if name not in FLAGS.FlagDict():
+      raise NameError('Unknown flag %s in --%s variant %s' % (
+          name, flag, spec))
+    overrides.append((name, value))
+  if fields[0] not in ('builtin', 'bnb', 'mitm', 'heuristic', 'glpk',
+                       'highs'):
+    raise NameError('Unknown mode %s in --%s variant %s' % (
+        fields[0], flag, spec))
+  return (fields[0], overrides)
+
+class PortfolioOptimizer(OptimizerBase):
+  """
+  Races the variants of --portfolio in parallel processes on the loaded
+  model. They share the best price found, for pruning. The first variant
+  that proves its solution optimal wins; without one, the best solution
+  after --time_budget seconds does. The winner is appended to the history
+  in --cachedir.
+  """
+
+  def Run(self):
+    # each variant decomposes the model itself
+    self.Solve()
+
+  def Solve(self):
+    print 'Racing %d variants for at most %g seconds: %s' % (
+        len(FLAGS.portfolio), FLAGS.time_budget, ', '.join(FLAGS.portfolio))
+    start_time = time.time()
+    queue = multiprocessing.Queue()
+    incumbent = multiprocessing.Value('d', 1.e10)
+    processes = [
+        multiprocessing.Process(target=RunVariant,
+                                args=(self, k, queue, incumbent))
+        for k in xrange(len(FLAGS.portfolio))]
+    # price, variant, orders or mask of the best solution
+    best = {'price': 1.e10, 'variant': None, 'orders': None, 'mask': None}
+    proven = False
+    running = len(processes)
+    try:
+      for process in processes:
+        StartProcessGroup(process)
+      while running and not proven:
+        seconds_left = start_time + FLAGS.time_budget - time.time()
+        if seconds_left <= 0:
+          break
+        try:
+          message = queue.get(True, min(1, seconds_left))
+        except Queue.Empty:
+          continue
+        kind, variant = message[:2]
+        if kind == 'failed':
+          print 'Variant %s failed: %s' % (FLAGS.portfolio[variant], message[2])
+          running -= 1
+          continue
+        price = message[2]
+        if kind == 'done':
+          running -= 1
+          print '%6.1fs: variant %s finished.' % (
+              time.time() - start_time, FLAGS.portfolio[variant])
+        if message[3] is not None and price < best['price'] - 1e-9:
+          best['price'] = price
+          best['variant'] = variant
+          best['orders'] = message[3] if kind == 'done' else None
+          best['mask'] = message[3] if kind == 'better' else None
+          with incumbent.get_lock():
+            if price < incumbent.value:
+              incumbent.value = price
+          print '%6.1fs: best price %.2f from variant %s.' % (
+              time.time() - start_time, price, FLAGS.portfolio[variant])
+        if (kind == 'done' and message[4] is not None and
+            message[4] >= best['price'] * (1 - FLAGS.target_gap) - 1e-6):
+          self._proven_bound = message[4]
+          proven = True
+    finally:
+      # stop the variants that are still running, with all their processes
+      for process in processes:
+        StopProcessGroup(process)
+
+    if best['variant'] is None:
+      return
+    if best['orders'] is not None:
+      self._order_bricks = best['orders']
+    else:
+      self._order_bricks = self._index.Order(best['mask'])
+    winner = FLAGS.portfolio[best['variant']]
+    print 'Variant %s won after %.1f seconds%s.' % (
+        winner, time.time() - start_time,
+        ', proven optimal' if proven else '')
+    self._RecordWinner(winner, time.time() - start_time, proven)
+
+  def _RecordWinner(self, winner, seconds, proven):
+    """Appends the result of the race to the history in --cachedir."""
+    record = {
+        'date': datetime.datetime.now().isoformat(),
+        'model': self.ModelHash(),
+        'parts': self._index.NumParts(),
+        'shops': self._index.NumShops(),
+        'free_shops': self._index.NumFreeShops(),
+        'variants': FLAGS.portfolio,
+        'winner': winner,
+        'seconds': round(seconds, 2),
+        'price': round(self.GrossGrandTotal(), 5),
+        'proven': proven}
+    try:
+      os.makedirs(FLAGS.cachedir)
+    except OSError:
+      pass
+    history_file = open(os.path.join(FLAGS.cachedir, PORTFOLIO_HISTORY), 'a')
+    try:
+      history_file.write(json.dumps(record, sort_keys=True) + '\n')
+    finally:
+      history_file.close()
+
+
+def RunTrial(model, spec, queue):
+  """
+  Runs variant spec of --auto_variants on a copy of the loaded model, in a
+  process of its own. Sends ('done', seconds) or ('failed', message).
+  """
+  # a process group of its own, so that a trial that takes too long can be
+  # stopped together with its worker processes and solvers
+  os.setpgrp()
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    mode, overrides = ParseVariant(spec, 'auto_variants')
+    for name, value in overrides:
+      FLAGS[name].Parse(value)
+    FLAGS.mode = mode
+    # a cached solution or checkpoint would take no time
+    FLAGS.rerun_solver = True
+    FLAGS.resume = False
+    trial = CreateOptimizer()
+    trial.__dict__.update(model.__dict__)
+    trial._max_shops = trial._MaxShops()
+    start = time.time()
+    trial.Run()
+  except Exception, e:
+    queue.put(('failed', str(e)))
+    return
+  queue.put(('done', time.time() - start))
+
+def SampleSeconds(optimizer, timed=True):
+  """
+  Returns (seconds, combinations) of the search of the BuiltinOptimizer
+  optimizer on one process, the seconds extrapolated from timing its last
+  combinations. These have the most shops, so they take the longest.
+  Unless timed, it only counts the combinations and returns 0 seconds.
+  """
+  enumeration = optimizer._Enumeration()
+  if enumeration is None:
+    return (0.0, 0)
+  label, func, total = enumeration
+  if not timed:
+    return (0.0, total)
+  InitWorker(optimizer)
+  start = time.time()
+  done = 0
+  count = 1024
+  while done < total and time.time() - start < AUTO_SAMPLE_SECONDS:
+    count = min(count, total - done)
+    func(optimizer, total - done - count, total - done)
+    done += count
+    count *= 2
+  return ((time.time() - start) * total / done, total)
+
+class AutoOptimizer(OptimizerBase):
+  """
+  Chooses a variant of --auto_variants and the --consider_shops for the
+  model from short trials, then loads the model with them and optimizes it.
+
+  The builtin searches know how many combinations they try, only their
+  speed is timed on a sample. The other variants run on more and more
+  shops, each run in a process of its own that is stopped when it takes
+  too long, and their time for more shops is extrapolated from the last
+  runs. The variant that can consider the most shops within --time_budget
+  wins, of those the fastest one. If none can consider the critical shops,
+  the heuristic searches all shops for the rest of --time_budget.
+  """
+
+  def Load(self, parts, ldd_file_name, shop_data, allow_used=[]):
+    start_time = time.time()
+    self._load_args = (parts, ldd_file_name, shop_data, allow_used)
+    # dict int(consider_shops) -> OptimizerBase of the model
+    self._models = {}
+    all_shops = set(o['shop_name'] for p in shop_data for o in shop_data[p])
+    model = self._Model(len(all_shops) + 1)
+    num_critical = len(model._critical_shops)
+    most = num_critical + max(1, len(model._supplemental_shops))
+    self._models[most] = model
+    # each step adds about an eighth more shops
+    sizes = []
+    num_shops = num_critical + 1
+    while num_shops < most:
+      sizes.append(num_shops)
+      num_shops += max(1, num_shops // 8)
+    sizes.append(most)
+
+    print 'Auto: timing %s on %d to %d shops.' % (
+        ', '.join(FLAGS.auto_variants), sizes[0], most)
+    budget = FLAGS.time_budget * (1 - AUTO_CALIBRATION_SHARE)
+    deadline = start_time + FLAGS.time_budget * AUTO_CALIBRATION_SHARE
+    # [(-shops, seconds, variant)] of the variants that fit into the budget
+    fits = []
+    for k, spec in enumerate(FLAGS.auto_variants):
+      # each variant gets its share of the time left for the trials
+      variant_deadline = time.time() + (deadline - time.time()) / (
+          len(FLAGS.auto_variants) - k)
+      fit = self._Fit(spec, sizes, variant_deadline, budget)
+      if fit is not None:
+        fits.append((-fit[0], fit[1], k))
+
+    if fits:
+      num_shops, seconds, k = min(fits)
+      num_shops = -num_shops
+      spec = FLAGS.auto_variants[k]
+      print ('Auto: running %s with --consider_shops=%d, expected to take '
+             '%.1f seconds.' % (spec, num_shops, seconds))
+    else:
+      num_shops = most
+      spec = 'heuristic'
+      FLAGS.time_budget = max(1.0,
+                              start_time + FLAGS.time_budget - time.time())
+      print ('Auto: no variant can consider %d shops in time, running '
+             'heuristic with --consider_shops=%d.' % (sizes[0], num_shops))
+    del self._models
+    mode, overrides = ParseVariant(spec, 'auto_variants')
+    for name, value in overrides:
+      FLAGS[name].Parse(value)
+    FLAGS.mode = mode
+    FLAGS.consider_shops = num_shops
+    self._optimizer = CreateOptimizer()
+    self._optimizer.Load(parts, ldd_file_name, shop_data, allow_used)
+    self.__dict__.update(self._optimizer.__dict__)
+
+  def Run(self):
+    self._optimizer.Run()
+    self.__dict__.update(self._optimizer.__dict__)
+
+  def _Model(self, num_shops):
+    """
+    The model loaded with --consider_shops=num_shops, without output. Sets
+    --consider_shops, which some optimizers look at.
+    """
+    FLAGS.consider_shops = num_shops
+    if num_shops not in self._models:
+      stdout = sys.stdout
+      sys.stdout = open(os.devnull, 'w')
+      try:
+        model = OptimizerBase()
+        model.Load(*self._load_args)
+      finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+      self._models[num_shops] = model
+    return self._models[num_shops]
+
+  def _Fit(self, spec, sizes, deadline, budget):
+    """
+    Times variant spec on the numbers of shops of sizes, fewest first,
+    until it would take longer than budget seconds. From deadline on, or
+    after a trial took too long, the times are extrapolated. For the
+    builtin searches, that is their combinations at the speed of the last
+    sample. Returns (shops, seconds) of the most shops it is expected to
+    optimize within budget, None if none.
+    """
+    mode, overrides = ParseVariant(spec, 'auto_variants')
+    fit = None
+    space = None
+    # [(shops, seconds)] of the trials and extrapolations
+    times = []
+    measured = True
+    # seconds per combination of the last sample of a builtin search
+    rate = None
+    try:
+      for num_shops in sizes:
+        if mode == 'builtin':
+          if time.time() < deadline:
+            seconds, combinations = self._SampleSeconds(overrides, num_shops)
+            if combinations:
+              rate = seconds / combinations
+          elif rate is not None:
+            seconds, combinations = self._SampleSeconds(
+                overrides, num_shops, rate)
+          else:
+            break
+          size = '%d combinations' % combinations
+        elif measured and time.time() < deadline:
+          limit = min(FLAGS.time_budget * AUTO_TRIAL_SHARE,
+                      deadline - time.time())
+          seconds = self._TrialSeconds(spec, num_shops, limit)
+          if seconds is None:
+            if not times:
+              break
+            # it's slower than the last trials suggest, so the time
+            # doubles for each additional shop, as in the worst case
+            measured = False
+            last_shops, last_seconds = times[-1]
+            seconds = max(limit,
+                          last_seconds * 2 ** (num_shops - last_shops))
+        elif times:
+          seconds = self._Extrapolate(times, num_shops)
+        else:
+          break
+        if mode != 'builtin':
+          size = self._SearchSpace(mode, num_shops)
+        if seconds > budget:
+          break
+        times.append((num_shops, seconds))
+        fit = (num_shops, seconds)
+        space = size
+    except NameError, e:
+      print 'Auto: %s failed: %s' % (spec, e)
+      return None
+    if fit is None:
+      print 'Auto: %s can\'t consider %d shops in time.' % (spec, sizes[0])
+    else:
+      print 'Auto: %s can consider %d shops in about %.1f seconds, %s.' % (
+          spec, fit[0], fit[1], space)
+    return fit
+
+  def _SampleSeconds(self, overrides, num_shops, rate=None):
+    """
+    Returns (seconds, combinations) of the builtin search with the flags of
+    overrides on num_shops shops, from timing a sample of each group of
+    parts it optimizes on its own. With rate, the seconds per combination
+    of an earlier sample, it only counts the combinations.
+    """
+    model = self._Model(num_shops)
+    saved = [(name, FLAGS[name].value) for name, value in overrides]
+    try:
+      for name, value in overrides:
+        FLAGS[name].Parse(value)
+      FLAGS.mode = 'builtin'
+      optimizer = CreateOptimizer()
+      optimizer.__dict__.update(model.__dict__)
+      optimizer._max_shops = optimizer._MaxShops()
+      components = optimizer._Decomposition()
+      if len(components) < 2:
+        components = [optimizer]
+      samples = [SampleSeconds(component, rate is None)
+                 for component in components]
+      jobs = FLAGS.jobs
+    finally:
+      for name, value in saved:
+        FLAGS[name].value = value
+      FLAGS.mode = 'auto'
+    combinations = sum(total for seconds, total in samples)
+    if rate is not None:
+      return (rate * combinations, combinations)
+    return (sum(seconds for seconds, total in samples) / jobs, combinations)
+
+  def _TrialSeconds(self, spec, num_shops, limit):
+    """
+    Runs variant spec on num_shops shops in a process of its own. Returns
+    the seconds it took, None if it took longer than limit. Raises
+    NameError if it failed.
+    """
+    model = self._Model(num_shops)
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=RunTrial,
+                                      args=(model, spec, queue))
+    message = None
+    try:
+      StartProcessGroup(process)
+      message = queue.get(True, limit)
+    except Queue.Empty:
+      pass
+    finally:
+      StopProcessGroup(process)
+    if message is None:
+      return None
+    if message[0] == 'failed':
+      raise NameError(message[1])
+    return message[1]
+
+  def _SearchSpace(self, mode, num_shops):
+    """Describes how big the search of mode on num_shops shops is."""
+    index = self._Model(num_shops)._index
+    if mode in ('glpk', 'highs'):
+      return '%d binary and %d integer variables' % (
+          index.NumShops(), sum(len(offers) for offers in index.part_offers))
+    return 'at most 2^%d combinations' % index.NumFreeShops()
+
+  @staticmethod
+  def _Extrapolate(times, num_shops):
+    """
+    Seconds for num_shops shops from the [(shops, seconds)] so far, if every
+    additional shop takes as many times longer as between the last two,
+    at least as long and at most twice as long.
+    """
+    last_shops, last_seconds = times[-1]
+    growth = 2.0
+    if len(times) > 1:
+      shops, seconds = times[-2]
+      if seconds > 0 and last_shops > shops:
+        growth = (last_seconds / seconds) ** (1.0 / (last_shops - shops))
+        growth = min(2.0, max(1.0, growth))
+    return last_seconds * growth ** (num_shops - last_shops)
+
+
+def TrackFrontier():
+  """Whether the searches keep the cheapest combination of each size."""
+  return FLAGS.frontier or bool(FLAGS.shop_fix_cost_sweep)
+
+def SweepFixCosts():
+  """The shop fix costs of --shop_fix_cost_sweep, in increasing order."""
+  if not FLAGS.shop_fix_cost_sweep:
+    return []
+  try:
+    lo, hi, step = [float(v) for v in FLAGS.shop_fix_cost_sweep.split(':')]
+  except ValueError:
+    raise NameError('Expected lo:hi:step in --shop_fix_cost_sweep, not %s' %
+                    FLAGS.shop_fix_cost_sweep)
+  if step <= 0 or hi < lo:
+    raise NameError('--shop_fix_cost_sweep needs lo <= hi and step > 0')
+  # multiples of step, adding it up would add up its rounding errors
+  return [lo + k * step for k in xrange(int(math.floor((hi - lo) / step +
+                                                        1e-9)) + 1)]
+
 def CreateOptimizer():
+  SweepFixCosts()
   if FLAGS.mode == 'builtin':
+    if FLAGS.evaluator == 'numpy' and numpy is None:
+      raise NameError('--evaluator=numpy needs the numpy module')
     return BuiltinOptimizer()
+  elif FLAGS.mode == 'bnb':
+    return BnbOptimizer()
+  elif FLAGS.mode == 'mitm':
+    return MitmOptimizer()
+  elif FLAGS.mode == 'heuristic':
+    return HeuristicOptimizer()
   elif FLAGS.mode == 'glpk':
+    if distutils.spawn.find_executable('glpsol') is None:
+      raise NameError('--mode=glpk needs the glpsol program in the PATH')
     return GlpkSolver()
+  elif FLAGS.mode == 'highs':
+    if distutils.spawn.find_executable('highs') is None:
+      raise NameError('--mode=highs needs the highs program in the PATH')
+    return HighsSolver()
+  elif FLAGS.mode == 'portfolio':
+    for spec in FLAGS.portfolio:
+      ParseVariant(spec)
+    return PortfolioOptimizer()
+  elif FLAGS.mode == 'auto':
+    for spec in FLAGS.auto_variants:
+      ParseVariant(spec, 'auto_variants')
+    return AutoOptimizer()
   else:
     raise NameError('Unknown mode %s' % FLAGS.mode)
@@ -95,7 +95,7 @@ HTML_SKELETON = """
 <table>
 %s
 </table>
-<h4>Orders</h4>
+%s%s%s<h4>Orders</h4>
 <table>
 %s
 </table>
@@ -130,6 +130,14 @@ TOTAL_SKELETON = """
 <td class="rightalign"><b>%.2f</b></td>
 </tr>
 <tr>
+<td>Lower bound of the gross cost:</td>
+<td class="rightalign">%s</td>
+</tr>
+<tr>
+<td>Gap to the lower bound:</td>
+<td class="rightalign">%s</td>
+</tr>
+<tr>
 <tr>
 <td>Number of parts on order:</td>
 <td class="rightalign">%d</td>
@@ -140,6 +148,101 @@ TOTAL_SKELETON = """
 </tr>
 """
 
+FRONTIER_SKELETON = """
+<h4>Cheapest orders by number of shops</h4>
+<table>
+<tr class="head">
+<td class="rightalign">Shops</td>
+<td class="rightalign">Gross cost</td>
+<td class="rightalign">Saving</td>
+<td>Shops to order from</td>
+</tr>
+%s
+</table>
+"""
+
+FRONTIER_ROW = """
+<tr>
+<td class="rightalign">%d</td>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%s</td>
+<td>%s</td>
+</tr>
+"""
+
+SWEEP_SKELETON = """
+<h4>Cheapest orders by shop fix cost</h4>
+%s
+<table>
+<tr class="head">
+<td class="rightalign">Fix cost</td>
+<td class="rightalign">Net cost</td>
+<td class="rightalign">Gross cost</td>
+<td class="rightalign">Shops</td>
+<td>Shops to order from</td>
+</tr>
+%s
+</table>
+"""
+
+SWEEP_ROW = """
+<tr>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%d</td>
+<td>%s</td>
+</tr>
+"""
+
+# Chart of the gross cost over the fix cost, the number of shops is written
+# where it changes.
+SWEEP_CHART = """
+<svg xmlns="http://www.w3.org/2000/svg" width="%(width)d" height="%(height)d"
+     font-family="sans-serif" font-size="11">
+<line x1="%(left)d" y1="%(bottom)d" x2="%(right)d" y2="%(bottom)d"
+      stroke="black"/>
+<line x1="%(left)d" y1="%(top)d" x2="%(left)d" y2="%(bottom)d"
+      stroke="black"/>
+<text x="%(left)d" y="%(x_label)d" text-anchor="middle">%(lo).2f</text>
+<text x="%(right)d" y="%(x_label)d" text-anchor="middle">%(hi).2f</text>
+<text x="%(center)d" y="%(x_label)d" text-anchor="middle">Fix cost</text>
+<text x="%(y_label)d" y="%(bottom)d" text-anchor="end">%(min).2f</text>
+<text x="%(y_label)d" y="%(top)d" text-anchor="end">%(max).2f</text>
+<polyline fill="none" stroke="#0000c0" points="%(points)s"/>
+%(marks)s
+</svg>
+"""
+
+SWEEP_MARK = """
+<circle cx="%.1f" cy="%.1f" r="3" fill="#0000c0"/>
+<text x="%.1f" y="%.1f" text-anchor="middle">%d shops</text>
+"""
+
+ALTERNATIVES_SKELETON = """
+<h4>Alternative orders</h4>
+<table>
+<tr class="head">
+<td class="rightalign">Gross cost</td>
+<td class="rightalign">More</td>
+<td class="rightalign">Shops</td>
+<td>Without</td>
+<td>With</td>
+</tr>
+%s
+</table>
+"""
+
+ALTERNATIVES_ROW = """
+<tr>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%d</td>
+<td>%s</td>
+<td>%s</td>
+</tr>
+"""
+
 ORDER_SHOPHEAD = """
 <tr class="head">
 <td colspan="7">%s</td>
@@ -229,6 +332,56 @@ UNSELECTED_ROW = """
 </tr>
 """
 
+SCENARIOS_SKELETON = """
+<html>
+<head>
+<title>%s</title>
+<style type="text/css">
+%s
+</style>
+</head>
+<body>
+<h3>%s</h3>
+<table>
+<tr class="head">
+<td>Scenario</td>
+<td>Flags</td>
+<td class="rightalign">Gross cost</td>
+<td class="rightalign">Net cost</td>
+<td class="rightalign">Shops</td>
+<td class="rightalign">Gap</td>
+<td class="rightalign">Seconds</td>
+<td>Shops to order from</td>
+</tr>
+%s
+</table>
+<br/>
+Generated by <a href="http://code.google.com/p/bltools">bltools</a>.
+</body>
+</html>
+"""
+
+SCENARIOS_ROW = """
+<tr>
+<td>%s</td>
+<td>%s</td>
+<td class="rightalign"><b>%.2f</b></td>
+<td class="rightalign">%.2f</td>
+<td class="rightalign">%d</td>
+<td class="rightalign">%s</td>
+<td class="rightalign">%.1f</td>
+<td>%s</td>
+</tr>
+"""
+
+SCENARIOS_ERROR_ROW = """
+<tr class="unselected">
+<td>%s</td>
+<td>%s</td>
+<td colspan="6">%s</td>
+</tr>
+"""
+
 SHOP_LINK = 'http://www.bricklink.com/store.asp?p=%s'
 CATALOG_LINK = 'http://www.bricklink.com/catalogItem.asp?P=%s&colorID=%s'
 
@@ -288,6 +441,117 @@ def PrintOrdersText(optimizer, shop_fix_cost):
           LeftPad('%.2f' % unit_price, 8),
           LeftPad('%.2f' % (unit_price * num_bricks), 8))
   print "Total: %10.2f, Gross %10.2f, Shops: %3d" % (total_netto, total_brutto, len(orders))
+  bound = optimizer.LowerBound()
+  if (bound is not None):
+    print "Cost %.2f, lower bound %.2f, gap %.2f%%" % (
+        total_brutto, bound, 100 * optimizer.Gap())
+
+def PrintFrontierText(optimizer):
+  frontier = optimizer.Frontier()
+  if (not frontier):
+    return
+  print 'Cheapest orders by number of shops:'
+  print ' Shops      Gross   Saving  Shops to order from'
+  previous = None
+  for num_shops, cost, orders in frontier:
+    saving = '-'
+    if (previous is not None):
+      saving = '%.2f' % (previous - cost)
+    print ' %5d %10.2f %8s  %s' % (
+        num_shops, cost, saving, ', '.join(sorted(orders)))
+    previous = cost
+
+def PrintSweepText(optimizer):
+  sweep = optimizer.Sweep()
+  if (not sweep):
+    return
+  print 'Cheapest orders by shop fix cost:'
+  print '   Fix cost      Gross  Shops  Shops to order from'
+  for fix_cost, cost, orders in sweep:
+    print ' %10.2f %10.2f  %5d  %s' % (
+        fix_cost, cost, len(orders), ', '.join(sorted(orders)))
+
+def SweepChart(sweep):
+  width, height = 600, 240
+  left, right, top, bottom = 70, width - 20, 20, height - 30
+  lo, hi = sweep[0][0], sweep[-1][0]
+  costs = [cost for fix_cost, cost, orders in sweep]
+  low, high = min(costs), max(costs)
+  def X(fix_cost):
+    return left + (right - left) * (fix_cost - lo) / max(hi - lo, 1e-9)
+  def Y(cost):
+    return bottom - (bottom - top) * (cost - low) / max(high - low, 1e-9)
+  marks = ''
+  num_shops = None
+  for fix_cost, cost, orders in sweep:
+    if (len(orders) != num_shops):
+      num_shops = len(orders)
+      marks += SWEEP_MARK % (X(fix_cost), Y(cost), X(fix_cost), Y(cost) - 6,
+                             num_shops)
+  return SWEEP_CHART % {
+      'width': width, 'height': height,
+      'left': left, 'right': right, 'top': top, 'bottom': bottom,
+      'center': (left + right) / 2, 'x_label': bottom + 18,
+      'y_label': left - 6, 'lo': lo, 'hi': hi, 'min': low, 'max': high,
+      'points': ' '.join('%.1f,%.1f' % (X(fix_cost), Y(cost))
+                         for fix_cost, cost, orders in sweep),
+      'marks': marks}
+
+def PrintAlternativesText(optimizer):
+  alternatives = optimizer.Alternatives()
+  orders = optimizer.Orders()
+  if (not alternatives or orders == None):
+    return
+  cost = optimizer.GrossGrandTotal()
+  print 'Alternative orders:'
+  print '      Gross     More  Shops  Changes'
+  for alternative_cost, alternative in alternatives:
+    changes = ['-%s' % shop for shop in sorted(orders)
+               if shop not in alternative]
+    changes += ['+%s' % shop for shop in sorted(alternative)
+                if shop not in orders]
+    print ' %10.2f %8.2f  %5d  %s' % (
+        alternative_cost, alternative_cost - cost, len(alternative),
+        ' '.join(changes))
+
+def PrintScenariosText(results):
+  print 'Scenarios:'
+  print ' %s      Gross        Net  Shops      Gap  Seconds  Flags' % (
+      RightPad('Name', 20))
+  for result in results:
+    if ('error' in result):
+      print ' %s  %s' % (RightPad(result['name'], 20), result['error'])
+      continue
+    gap = '-'
+    if (result['gap'] is not None):
+      gap = '%.2f%%' % (100 * result['gap'])
+    print ' %s %10.2f %10.2f  %5d %8s %8.1f  %s' % (
+        RightPad(result['name'], 20), result['gross'], result['net'],
+        len(result['shops']), gap, result['seconds'], result['flags'])
+
+def PrintScenariosHtml(results, ldd_file_name, output_html_file_name):
+  f = open(output_html_file_name, "w")
+  try:
+    title = 'Scenarios for %s' % ldd_file_name
+    rows = ''
+    for result in results:
+      if ('error' in result):
+        rows += SCENARIOS_ERROR_ROW % (
+            cgi.escape(result['name']), cgi.escape(result['flags']),
+            cgi.escape(result['error']))
+        continue
+      gap = '-'
+      if (result['gap'] is not None):
+        gap = '%.2f%%' % (100 * result['gap'])
+      rows += SCENARIOS_ROW % (
+          cgi.escape(result['name']), cgi.escape(result['flags']),
+          result['gross'], result['net'], len(result['shops']), gap,
+          result['seconds'],
+          ', '.join(MakeLink(SHOP_LINK % shop, shop)
+                    for shop in result['shops']))
+    f.write(SCENARIOS_SKELETON % (title, CSS, title, rows))
+  finally:
+    f.close()
 
 def PrintAllHtml(
     optimizer,
@@ -319,8 +583,7 @@ def PrintAllHtml(
         num_shop_part_types += 1
         num_all_part_types += 1
         used = '&nbsp;'
-        this_shop_data = [x for x in shop_data[part] if x['shop_name'] == shop][0]
-        imglink = this_shop_data['lotpic']
+        imglink = optimizer.Offer(shop, part)['lotpic']
         if (part.type() == 'P'):
           link = PART_LINK % (part.id(), part.color())
           color_name = lfxml.TRANSLATE_COLORS_BL[int(part.color())][1
@@ -364,6 +627,11 @@ def PrintAllHtml(
       orders_fragment += ORDER_SEPARATOR
 
     total_cost = optimizer.NetGrandTotal()
+    bound = optimizer.LowerBound()
+    bound_text = gap_text = '-'
+    if (bound is not None):
+      bound_text = '%.2f' % bound
+      gap_text = '%.2f%%' % (100 * optimizer.Gap())
     total_fragment = TOTAL_SKELETON % (
         len(optimizer.PartsNeeded()),
         optimizer.NumBricksNeeded(),
@@ -371,9 +639,54 @@ def PrintAllHtml(
         total_cost,
         shop_fix_cost,
         total_cost + shop_fix_cost * len(orders),
+        bound_text,
+        gap_text,
         num_all_part_types,
         num_all_parts)
 
+    frontier_fragment = ''
+    frontier = optimizer.Frontier()
+    if (frontier):
+      rows = ''
+      previous = None
+      for num_shops, cost, frontier_orders in frontier:
+        saving = '-'
+        if (previous is not None):
+          saving = '%.2f' % (previous - cost)
+        rows += FRONTIER_ROW % (
+            num_shops, cost, saving,
+            ', '.join(MakeLink(SHOP_LINK % shop, shop)
+                      for shop in sorted(frontier_orders)))
+        previous = cost
+      frontier_fragment = FRONTIER_SKELETON % rows
+
+    sweep_fragment = ''
+    sweep = optimizer.Sweep()
+    if (sweep):
+      rows = ''
+      for fix_cost, cost, sweep_orders in sweep:
+        rows += SWEEP_ROW % (
+            fix_cost, cost - fix_cost * len(sweep_orders), cost,
+            len(sweep_orders),
+            ', '.join(MakeLink(SHOP_LINK % shop, shop)
+                      for shop in sorted(sweep_orders)))
+      sweep_fragment = SWEEP_SKELETON % (SweepChart(sweep), rows)
+
+    alternatives_fragment = ''
+    alternatives = optimizer.Alternatives()
+    if (alternatives):
+      rows = ''
+      for alternative_cost, alternative in alternatives:
+        rows += ALTERNATIVES_ROW % (
+            alternative_cost,
+            alternative_cost - optimizer.GrossGrandTotal(),
+            len(alternative),
+            ', '.join(MakeLink(SHOP_LINK % shop, shop)
+                      for shop in sorted(orders) if shop not in alternative),
+            ', '.join(MakeLink(SHOP_LINK % shop, shop)
+                      for shop in sorted(alternative) if shop not in orders))
+      alternatives_fragment = ALTERNATIVES_SKELETON % rows
+
     considered_fragment = CONSIDERED_HEAD
     for shop in sorted(optimizer.CriticalShops()):
       considered_fragment += CONSIDERED_ROW % (
@@ -392,7 +705,10 @@ def PrintAllHtml(
           '%.2f' % -optimizer.UnselectedShops()[shop]['score'])
     html = HTML_SKELETON % (
         title, CSS, JAVASCRIPT, title,
-        total_fragment, orders_fragment, considered_fragment)
+        total_fragment, frontier_fragment, sweep_fragment,
+        alternatives_fragment,
+        orders_fragment,
+        considered_fragment)
     f.write(html)
   finally:
     f.close()
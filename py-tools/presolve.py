@@ -0,0 +1,169 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Exact reductions of the optimization model, before any solver runs.
+"""
+
+def _Log(msg):
+  print 'Presolve: %s' % msg
+
+def _ShopPrices(shops_for_parts):
+  # dict str(shop) -> {item(part): float(unit price)}
+  shop_prices = {}
+  for p in shops_for_parts:
+    for o in shops_for_parts[p]:
+      shop_prices.setdefault(o['shop_name'], {})[p] = o['unit_price']
+  return shop_prices
+
+def _FullLots(parts_needed, shops_for_parts):
+  # dict str(shop) -> set(item(part)) of the parts it has enough of
+  full_lots = {}
+  for p in shops_for_parts:
+    for o in shops_for_parts[p]:
+      if o['quantity'] >= parts_needed[p]:
+        full_lots.setdefault(o['shop_name'], set()).add(p)
+  return full_lots
+
+def _Dominates(prices_a, prices_b, full_b, min_buy_a, min_buy_b):
+  """True if shop b is at least as good as shop a for every part of a."""
+  for p in prices_a:
+    if p not in full_b or prices_b[p] > prices_a[p]:
+      return False
+  # Moving a's parts to b must not be the reason b misses its minimum buy,
+  # this is only certain if b has none or b costs exactly as much as a.
+  if min_buy_b > 0:
+    return (min_buy_b <= min_buy_a and
+            all(prices_b[p] == prices_a[p] for p in prices_a))
+  return True
+
+def Presolve(parts_needed, shops_for_parts, shops):
+  """
+  Shrinks the model without changing its optimal cost:
+  * shops that are the only source of a part are forced into every solution
+  * offers that can never be cheaper than the offer of a forced shop that
+    has enough of the part are removed
+  * shops that some other shop matches or beats on every part are dropped,
+    if that shop has enough of each of these parts
+  * parts with exactly the same offers are merged into one group, unless
+    some lot has fewer items than needed
+
+  parts_needed: dict str(part) -> int(quantity)
+  shops_for_parts: dict str(part) -> [dict(quantity, unit_price, shop_name)]
+  shops: dict str(shop) -> dict(min_buy, ...) of the candidate shops
+
+  Returns (shops_for_parts, shops, forced shops, part groups), the part
+  groups being a list of lists of parts.
+  """
+  shops_for_parts = dict(
+      (p, list(shops_for_parts[p])) for p in parts_needed)
+  shops = dict(shops)
+  forced = set()
+
+  changed = True
+  while changed:
+    changed = False
+
+    for p in sorted(shops_for_parts):
+      offers = shops_for_parts[p]
+      if len(offers) == 1 and offers[0]['shop_name'] not in forced:
+        forced.add(offers[0]['shop_name'])
+        _Log('fixed shop %s, it is the only source of %s' % (
+            offers[0]['shop_name'], p))
+        changed = True
+
+    for p in sorted(shops_for_parts):
+      offers = shops_for_parts[p]
+      forced_offers = sorted(
+          (o for o in offers if o['shop_name'] in forced and
+           o['quantity'] >= parts_needed[p]),
+          key=lambda o: (o['unit_price'], o['shop_name']))
+      if not forced_offers:
+        continue
+      best = forced_offers[0]
+      # A forced shop is always there, so other offers of the part are
+      # never needed unless their shop has to reach a minimum buy.
+      removed = [o for o in offers
+                 if o is not best and o['unit_price'] >= best['unit_price']
+                 and shops[o['shop_name']]['min_buy'] <= 0]
+      if removed:
+        removed_ids = set(id(o) for o in removed)
+        shops_for_parts[p] = [o for o in offers if id(o) not in removed_ids]
+        _Log('removed offers of %s from %s, forced shop %s is as cheap '
+             'or cheaper' % (
+                 p, ', '.join(sorted(o['shop_name'] for o in removed)),
+                 best['shop_name']))
+        changed = True
+
+    shop_prices = _ShopPrices(shops_for_parts)
+    full_lots = _FullLots(parts_needed, shops_for_parts)
+    for s in sorted(shops):
+      if s not in shop_prices:
+        del shops[s]
+        _Log('dropped shop %s, it has no offers left' % s)
+        changed = True
+
+    # Walk in reverse name order so that of two identical shops the one with
+    # the smaller name stays.
+    remaining = set(shops)
+    for a in sorted(shops, reverse=True):
+      if a in forced:
+        continue
+      for b in sorted(remaining):
+        if (b != a and _Dominates(shop_prices[a], shop_prices[b],
+                                  full_lots.get(b, ()),
+                                  shops[a]['min_buy'], shops[b]['min_buy'])):
+          remaining.remove(a)
+          del shops[a]
+          for p in shop_prices[a]:
+            shops_for_parts[p] = [
+                o for o in shops_for_parts[p] if o['shop_name'] != a]
+          _Log('dropped shop %s, shop %s is as cheap or cheaper for all '
+               'of its %d parts' % (a, b, len(shop_prices[a])))
+          changed = True
+          break
+
+  groups = {}
+  for p in sorted(shops_for_parts):
+    key = tuple(sorted(
+        (o['shop_name'], o['unit_price']) for o in shops_for_parts[p]))
+    # The quantity of a group is split across its shops as a whole, which
+    # only works if each shop has enough of each of its parts.
+    if any(o['quantity'] < parts_needed[p] for o in shops_for_parts[p]):
+      key = (p,)
+    groups.setdefault(key, []).append(p)
+  part_groups = sorted(groups.values())
+  for group in part_groups:
+    if len(group) > 1:
+      _Log('merged parts with identical offers: %s' % ', '.join(group))
+
+  _Log('%d shops fixed, %d shops left, %d parts in %d groups' % (
+      len(forced), len(shops), len(shops_for_parts), len(part_groups)))
+  return (shops_for_parts, shops, forced, part_groups)
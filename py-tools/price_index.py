@@ -0,0 +1,447 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Compact index of the offers the optimizers work on.
+"""
+
+import array
+import math
+
+# Price of a part in a shop that doesn't offer it.
+MISSING_PRICE = float('inf')
+
+# At most this many times the needed quantity of a part is bought from a
+# shop, to reach its minimum buy.
+MAX_ORDER_FACTOR = 10
+
+class PriceIndex(object):
+  """
+  Shops and part groups are numbered once, shop j is bit 1 << j in all shop
+  bit masks and group i is bit 1 << i in all part bit masks. Prices are kept
+  in a flat groups x shops array of doubles, MISSING_PRICE where there is no
+  offer.
+
+  A group is a list of parts with exactly the same offers, which the
+  optimizers handle as one part with the summed quantity. Without
+  part_groups, every part is a group of its own.
+
+  The free shops come first, sorted by name, then the forced shops that are
+  in every solution. So the free shops are bits 0 .. NumFreeShops() - 1 and
+  every combination of them is forced_mask | i for an i < 2**NumFreeShops().
+
+  The quantities of the lots are kept in the same way, a lot may have less
+  than the needed quantity. A group is bit 1 << i of partial_parts if one of
+  its lots is too small, the shop of that lot is bit 1 << j of partial_mask.
+  A shop with a minimum buy is bit 1 << j of min_buy_mask. NetCost() ignores
+  the minimum buy, it is a lower bound of TotalCost() which doesn't. The
+  price of the needed quantity from a single shop is a lower bound of both
+  of them, exact unless the combination has one of the shops of
+  repair_mask.
+  """
+
+  def __init__(self, parts_needed, shops_for_parts, shops,
+               forced_shops=(), part_groups=None):
+    forced = sorted(s for s in shops if s in forced_shops)
+    # [str(shop)], free shops then forced shops
+    self.shops = sorted(s for s in shops if s not in forced_shops) + forced
+    self.shop_ids = dict((self.shops[j], j) for j in xrange(len(self.shops)))
+    self.num_free_shops = len(self.shops) - len(forced)
+    self.forced_mask = ((1 << len(forced)) - 1) << self.num_free_shops
+
+    if part_groups is None:
+      part_groups = [[p] for p in parts_needed]
+    # [[item(part)]] of each group, sorted
+    self.members = sorted(sorted(g) for g in part_groups)
+    # [item(part)], the first part of each group
+    self.parts = [g[0] for g in self.members]
+    # dict item(part) -> int(group)
+    self.part_ids = dict(
+        (p, i) for i in xrange(len(self.members)) for p in self.members[i])
+    self._parts_needed = parts_needed
+    # [int(quantity)] needed of each group
+    self.demand = [sum(parts_needed[p] for p in g) for g in self.members]
+
+    num_shops = len(self.shops)
+    self.prices = (
+        array.array('d', [MISSING_PRICE]) * (len(self.parts) * num_shops))
+    self.quantities = array.array('l', [0]) * (len(self.parts) * num_shops)
+    # [int] bit mask of the shops offering each group
+    self.part_shops = [0] * len(self.parts)
+    # [int] bit mask of the groups offered by each shop
+    self.shop_parts = [0] * num_shops
+    # [[(int(shop), float(unit price))]] of each group, cheapest first
+    self.part_offers = [[] for p in self.parts]
+    # [[(int(group), float(unit price))]] of each shop
+    self.shop_offers = [[] for s in self.shops]
+    # dict (item(part), int(shop)) -> dict(quantity, unit_price, shop_name)
+    self._offers = {}
+    # [float] minimum net price of an order from each shop
+    self.min_buy = [0.0] * num_shops
+
+    for i in xrange(len(self.parts)):
+      # all parts of a group have the same prices, those of the first count
+      for p in self.members[i]:
+        for o in shops_for_parts[p]:
+          j = self.shop_ids.get(o['shop_name'])
+          if j is None:
+            continue
+          existing = self._offers.get((p, j))
+          if existing is not None and existing['unit_price'] <= o['unit_price']:
+            continue
+          self._offers[(p, j)] = o
+          self.min_buy[j] = o.get('min_buy', 0.0)
+          if p == self.parts[i]:
+            self.prices[i * num_shops + j] = o['unit_price']
+            self.part_shops[i] |= 1 << j
+            self.shop_parts[j] |= 1 << i
+      self.part_offers[i] = sorted(
+          ((j, self.prices[i * num_shops + j])
+           for j in xrange(num_shops) if self.part_shops[i] & 1 << j),
+          key=lambda x: x[1])
+      for j, price in self.part_offers[i]:
+        self.shop_offers[j].append((i, price))
+        # the lots of merged parts are all big enough, see presolve.py
+        self.quantities[i * num_shops + j] = sum(
+            self._offers[(p, j)]['quantity'] for p in self.members[i])
+    self.min_buy_mask = sum(
+        1 << j for j in xrange(num_shops) if self.min_buy[j] > 0)
+    self.partial_parts = 0
+    self.partial_mask = 0
+    for i in xrange(len(self.parts)):
+      for j, price in self.part_offers[i]:
+        if self.quantities[i * num_shops + j] < self.demand[i]:
+          self.partial_parts |= 1 << i
+          self.partial_mask |= 1 << j
+    self.repair_mask = self.min_buy_mask | self.partial_mask
+
+  def NumParts(self):
+    return len(self.parts)
+
+  def NumShops(self):
+    return len(self.shops)
+
+  def NumFreeShops(self):
+    return self.num_free_shops
+
+  def UnitPrice(self, i, j):
+    return self.prices[i * len(self.shops) + j]
+
+  def Quantity(self, i, j):
+    return self.quantities[i * len(self.shops) + j]
+
+  def Offer(self, part, j):
+    return self._offers.get((part, j))
+
+  def ShopMask(self, shop_names):
+    """Bit mask of the shops, ignoring those that are not in the index."""
+    return sum(1 << self.shop_ids[s]
+               for s in set(shop_names) if s in self.shop_ids)
+
+  def ShopNames(self, mask):
+    return [self.shops[j] for j in xrange(len(self.shops)) if mask & 1 << j]
+
+  def HasAllParts(self, mask):
+    for shops in self.part_shops:
+      if not shops & mask:
+        return False
+    return True
+
+  def Cheapest(self, i, mask):
+    """Returns (shop, unit price) of the cheapest offer of group i in mask."""
+    for j, price in self.part_offers[i]:
+      if mask & 1 << j:
+        return (j, price)
+    return (None, MISSING_PRICE)
+
+  def NetCost(self, mask):
+    """
+    Net price of all parts from the shops in mask, None if they don't have
+    enough of every part. Each group is bought from the cheapest lots
+    first, which is the cheapest way as long as the minimum buy of the
+    shops is ignored, as it is here.
+    """
+    num_shops = len(self.shops)
+    total = 0.0
+    for i in xrange(len(self.parts)):
+      needed = self.demand[i]
+      for j, price in self.part_offers[i]:
+        if mask & 1 << j:
+          quantity = self.quantities[i * num_shops + j]
+          if quantity >= needed:
+            total += price * needed
+            needed = 0
+            break
+          total += price * quantity
+          needed -= quantity
+      if needed:
+        return None
+    return total
+
+  def TotalCost(self, mask, fix_cost):
+    """
+    Net cost of Allocate() plus fix_cost for every shop in mask, None if
+    incomplete or a shop misses its minimum buy.
+    """
+    allocation = self.Allocate(mask)
+    if allocation is None:
+      return None
+    return (allocation[0] +
+            bin(mask & ((1 << len(self.shops)) - 1)).count('1') * fix_cost)
+
+  def Allocate(self, mask):
+    """
+    The quantities bought of every group from the shops in mask, as
+    (net cost, dict (int(group), int(shop)) -> int(quantity)), None if the
+    shops don't have enough of every part or a shop can't be brought to its
+    minimum buy.
+
+    Every group is bought from the cheapest lots first, as in NetCost(). As
+    long as a shop then sells less than its minimum buy, it is either
+    filled up or dropped, whichever costs less, see _FillUp and _Drop. This
+    is a greedy repair, an optimal one would need a MIP like GlpkSolver.
+    """
+    num_shops = len(self.shops)
+    amounts = {}
+    net = 0.0
+    for i in xrange(len(self.parts)):
+      needed = self.demand[i]
+      for j, price in self.part_offers[i]:
+        if mask & 1 << j:
+          quantity = min(needed, self.quantities[i * num_shops + j])
+          amounts[(i, j)] = quantity
+          net += price * quantity
+          needed -= quantity
+          if not needed:
+            break
+      if needed:
+        return None
+    if mask & self.min_buy_mask:
+      spend = [0.0] * num_shops
+      for (i, j), quantity in amounts.iteritems():
+        spend[j] += self.UnitPrice(i, j) * quantity
+      while True:
+        short = [j for j in xrange(num_shops)
+                 if 1e-9 < spend[j] < self.min_buy[j] - 1e-9]
+        if not short:
+          break
+        # the shop that is furthest from its minimum buy is the most likely
+        # to be dropped
+        j = min(short, key=lambda j: spend[j] / self.min_buy[j])
+        fill = self._FillUp(j, amounts, spend)
+        drop = self._Drop(j, mask, amounts)
+        if fill is None and drop is None:
+          return None
+        if drop is None or fill is not None and fill[0] <= drop[0]:
+          cost, moves, added = fill
+        else:
+          cost, moves = drop
+          added = []
+          mask &= ~(1 << j)
+        net += cost
+        for i, k, l, quantity in moves:
+          amounts[(i, k)] -= quantity
+          if not amounts[(i, k)]:
+            del amounts[(i, k)]
+          amounts[(i, l)] = amounts.get((i, l), 0) + quantity
+          spend[k] -= self.UnitPrice(i, k) * quantity
+          spend[l] += self.UnitPrice(i, l) * quantity
+        for i, quantity in added:
+          amounts[(i, j)] = amounts.get((i, j), 0) + quantity
+          spend[j] += self.UnitPrice(i, j) * quantity
+    return (net, amounts)
+
+  def NumUsedShops(self, mask):
+    """The number of shops of mask Allocate() buys from, None if it has no
+    allocation."""
+    used = 0
+    if not mask & self.repair_mask:
+      for i in xrange(len(self.parts)):
+        j, price = self.Cheapest(i, mask)
+        if j is None:
+          return None
+        used |= 1 << j
+    else:
+      allocation = self.Allocate(mask)
+      if allocation is None:
+        return None
+      for i, j in allocation[1]:
+        used |= 1 << j
+    return bin(used).count('1')
+
+  def _FillUp(self, j, amounts, spend):
+    """
+    Plans to bring shop j to its minimum buy. Parts of j that are bought
+    elsewhere are moved to it, those that cost the least extra per amount
+    they add first, as long as that's cheaper than buying more than needed
+    and the shop they come from doesn't fall short of its own minimum buy.
+    The rest is bought as more than needed of the parts of j, up to its
+    lots and MAX_ORDER_FACTOR times the needed quantity.
+
+    Returns (extra cost, [(group, from shop, to shop, quantity)],
+    [(group, more quantity)]), None if j can't reach its minimum buy.
+    """
+    need = self.min_buy[j] - spend[j]
+    cost = 0.0
+    moves = []
+    left = {}
+    # how many more of each group j has and may sell
+    room = {}
+    bought = {}
+    for (i, k), quantity in amounts.iteritems():
+      bought[i] = bought.get(i, 0) + quantity
+    for i, price in self.shop_offers[j]:
+      room[i] = (min(self.Quantity(i, j), MAX_ORDER_FACTOR * self.demand[i]) -
+                 amounts.get((i, j), 0))
+    options = []
+    for (i, k), quantity in amounts.iteritems():
+      if k != j and i in room and self.UnitPrice(i, j) > 0:
+        price = self.UnitPrice(i, j)
+        options.append(((price - self.UnitPrice(i, k)) / price, i, k))
+    options.sort()
+    for ratio, i, k in options:
+      if need <= 1e-9:
+        break
+      price = self.UnitPrice(i, j)
+      other_price = self.UnitPrice(i, k)
+      quantity = min(amounts[(i, k)], room[i],
+                     int(math.ceil(need / price - 1e-9)))
+      if quantity <= 0:
+        continue
+      added = price * quantity
+      more = (price - other_price) * quantity
+      if more >= min(added, need):
+        continue
+      rest = left.get(k, spend[k]) - other_price * quantity
+      if 1e-9 < rest < self.min_buy[k] - 1e-9:
+        continue
+      left[k] = rest
+      room[i] -= quantity
+      moves.append((i, k, j, quantity))
+      cost += more
+      need -= added
+    added = []
+    if need > 1e-9:
+      # [(unit price, group, how many more can be bought)]
+      lots = []
+      for i, price in self.shop_offers[j]:
+        quantity = min(room[i],
+                       MAX_ORDER_FACTOR * self.demand[i] - bought.get(i, 0))
+        if price > 0 and quantity > 0:
+          lots.append((price, i, quantity))
+      # the least that covers the rest with a single group, else the
+      # groups with the most room first
+      single = [(int(math.ceil(need / price - 1e-9)) * price, i)
+                for price, i, quantity in lots
+                if quantity * price >= need - 1e-9]
+      if single:
+        more, i = min(single)
+        added.append((i, int(round(more / self.UnitPrice(i, j)))))
+        cost += more
+        need = 0
+      else:
+        lots.sort(key=lambda lot: -lot[0] * lot[2])
+        for price, i, quantity in lots:
+          if need <= 1e-9:
+            break
+          quantity = min(quantity, int(math.ceil(need / price - 1e-9)))
+          added.append((i, quantity))
+          cost += quantity * price
+          need -= quantity * price
+      if need > 1e-9:
+        return None
+    return (cost, moves, added)
+
+  def _Drop(self, j, mask, amounts):
+    """
+    Plans to buy nothing from shop j, its parts from the next cheapest lots
+    of mask. Returns (extra cost, [(group, from shop, to shop, quantity)]),
+    None if the other shops don't have enough of one of its parts.
+    """
+    rest = mask & ~(1 << j)
+    cost = 0.0
+    moves = []
+    for i, price in self.shop_offers[j]:
+      needed = amounts.get((i, j), 0)
+      if not needed:
+        continue
+      for k, other_price in self.part_offers[i]:
+        if rest & 1 << k:
+          quantity = min(needed, self.Quantity(i, k) - amounts.get((i, k), 0))
+          if quantity > 0:
+            moves.append((i, j, k, quantity))
+            cost += (other_price - price) * quantity
+            needed -= quantity
+            if not needed:
+              break
+      if needed:
+        return None
+    return (cost, moves)
+
+  def SplitQuantities(self, quantities):
+    """
+    Splits the quantities ordered of the groups, a dict (int(group),
+    int(shop)) -> int(quantity), to their parts as the orders dict str(shop)
+    -> {item(part): int(quantity)}. The shops of a group give each of its
+    parts the needed quantity in turn, then anything beyond the needed total
+    to the parts whose own lot at the shop still has room, as the quantity
+    of a merged group is that of all its lots together.
+    """
+    shops = {}
+    for (i, j), quantity in quantities.iteritems():
+      shops.setdefault(i, []).append((j, quantity))
+    order = {}
+    for i in shops:
+      needed = dict((p, self._parts_needed[p]) for p in self.members[i])
+      for j, quantity in sorted(shops[i]):
+        shop_order = order.setdefault(self.shops[j], {})
+        for beyond_need in (False, True):
+          for p in self.members[i]:
+            q = min(quantity,
+                    self._offers[(p, j)]['quantity'] - shop_order.get(p, 0))
+            if not beyond_need:
+              q = min(q, needed[p])
+            if q > 0:
+              shop_order[p] = shop_order.get(p, 0) + q
+              needed[p] -= q
+              quantity -= q
+        # only if the quantity exceeds the lots
+        if quantity > 0:
+          p = self.members[i][0]
+          shop_order[p] = shop_order.get(p, 0) + quantity
+    return order
+
+  def Order(self, mask):
+    """dict str(shop) -> {item(part): int(quantity)} of the quantities of
+    Allocate(), or None if there are none."""
+    allocation = self.Allocate(mask)
+    if allocation is None:
+      return None
+    return self.SplitQuantities(allocation[1])
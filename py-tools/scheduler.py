@@ -0,0 +1,178 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Distributes a range of work items over a multiprocessing pool.
+"""
+
+import Queue
+import time
+
+# Chunks are sized so that one takes about this long in one process.
+TARGET_CHUNK_SECONDS = 1.0
+
+# Size of the first chunks, before the throughput is known.
+INITIAL_CHUNK = 256
+
+# Weight of the last measured chunk in the throughput estimate.
+RATE_SMOOTHING = 0.3
+
+def _RunTimed(task, args):
+  start = time.time()
+  result = task(*args)
+  return (result, time.time() - start)
+
+class RangeScheduler(object):
+  """
+  Runs task(func, start, end) for consecutive chunks of [0, total), except
+  for the ranges [(start, end)] of skip, which were done before.
+
+  Chunks are handed out one at a time whenever a process becomes free, with
+  two chunks per process in flight. The chunk size follows the measured
+  throughput, so that each chunk takes about TARGET_CHUNK_SECONDS, but it is
+  never more than a fair share of what is left, so all processes run out of
+  work at about the same time. Without a pool, everything runs in the
+  calling process.
+  """
+
+  def __init__(self, pool, jobs, total, skip=()):
+    self._pool = pool
+    self._jobs = jobs
+    self._total = total
+    # the ranges still to hand out, in order, and the number of items in them
+    self._todo = []
+    self._completed = []
+    self._done = 0
+    start = 0
+    for skip_start, skip_end in sorted(skip):
+      skip_start = max(skip_start, start)
+      skip_end = min(skip_end, total)
+      if skip_start >= skip_end:
+        continue
+      if start < skip_start:
+        self._todo.append((start, skip_start))
+      self._completed.append((skip_start, skip_end))
+      self._done += skip_end - skip_start
+      start = skip_end
+    if start < total:
+      self._todo.append((start, total))
+    self._remaining = total - self._done
+    self._skipped = self._done
+    # items per second in one process
+    self._rate = None
+
+  def Done(self):
+    return self._done
+
+  def Completed(self):
+    """The ranges [(start, end)] that are done, merged and in order."""
+    merged = []
+    for start, end in sorted(self._completed):
+      if merged and merged[-1][1] >= start:
+        merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+      else:
+        merged.append((start, end))
+    self._completed = merged
+    return list(merged)
+
+  def _NextChunk(self):
+    if self._rate is None:
+      size = INITIAL_CHUNK
+    else:
+      size = int(self._rate * TARGET_CHUNK_SECONDS)
+    size = min(size, self._remaining // (2 * self._jobs))
+    start, todo_end = self._todo[0]
+    end = min(start + max(size, 1), todo_end)
+    if end == todo_end:
+      self._todo.pop(0)
+    else:
+      self._todo[0] = (end, todo_end)
+    self._remaining -= end - start
+    return (start, end)
+
+  def _Finish(self, start, end, elapsed):
+    rate = (end - start) / max(elapsed, 1e-3)
+    if self._rate is None:
+      self._rate = rate
+    else:
+      self._rate += RATE_SMOOTHING * (rate - self._rate)
+    self._done += end - start
+    self._completed.append((start, end))
+
+  def _Report(self, report, start_time):
+    if report:
+      elapsed = max(time.time() - start_time, 1e-3)
+      rate = (self._done - self._skipped) / elapsed
+      report(self._done, self._total, rate,
+             (self._total - self._done) / max(rate, 1e-3))
+
+  def Run(self, task, func, on_result, report=None, stop=None):
+    """
+    Calls on_result(result) for each chunk as it completes and
+    report(done, total, items per second, seconds left) after it. If stop()
+    becomes true after a chunk, returns False right away, without waiting
+    for the chunks still running. Returns True once all chunks are done.
+    """
+    start_time = time.time()
+    if self._pool is None:
+      while self._todo:
+        start, end = self._NextChunk()
+        result, elapsed = _RunTimed(task, (func, start, end))
+        self._Finish(start, end, elapsed)
+        on_result(result)
+        self._Report(report, start_time)
+        if stop and stop():
+          return False
+      return True
+
+    completed = Queue.Queue()
+    in_flight = {}
+    while self._todo or in_flight:
+      while self._todo and len(in_flight) < 2 * self._jobs:
+        start, end = self._NextChunk()
+        in_flight[(start, end)] = self._pool.apply_async(
+            _RunTimed, args=(task, (func, start, end)),
+            callback=lambda r, key=(start, end): completed.put(key))
+      try:
+        # with a timeout, so that Ctrl+C gets through
+        keys = [completed.get(True, 1)]
+      except Queue.Empty:
+        # a task that failed never calls back, get() raises its exception
+        keys = [key for key in in_flight
+                if in_flight[key].ready() and
+                not in_flight[key].successful()]
+      for key in keys:
+        result, elapsed = in_flight.pop(key).get()
+        self._Finish(key[0], key[1], elapsed)
+        on_result(result)
+        self._Report(report, start_time)
+        if stop and stop():
+          return False
+    return True
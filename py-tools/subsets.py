@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8
+#
+# Copyright (c) 2011-2012, Peter Dornbach
+#               2014-2014, Frank Löffler
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+#     * Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above
+# copyright notice, this list of conditions and the following disclaimer
+# in the documentation and/or other materials provided with the
+# distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Ranks of the subsets of n elements, as bit masks. The subsets are ordered
+by their size first and then colexicographically, which is the order of
+their values as integers. So the subsets with at most k elements are the
+ranks 0..Count(n, k)-1, and a range of ranks can be visited without looking
+at any larger subset.
+
+Within one size s, the rank of the subset {c_s > ... > c_1} is
+C(c_s, s) + ... + C(c_1, 1), the combinatorial number system.
+"""
+
+def Binomial(n, k):
+  """Number of subsets of n elements with k elements."""
+  if k < 0 or k > n:
+    return 0
+  result = 1
+  for i in xrange(min(k, n - k)):
+    result = result * (n - i) // (i + 1)
+  return result
+
+def Count(n, k):
+  """Number of subsets of n elements with at most k elements."""
+  return sum(Binomial(n, size) for size in xrange(min(n, k) + 1))
+
+def Unrank(n, rank):
+  """The subset of the given rank, 0 <= rank < 2**n."""
+  size = 0
+  while rank >= Binomial(n, size):
+    rank -= Binomial(n, size)
+    size += 1
+  mask = 0
+  c = n
+  for s in xrange(size, 0, -1):
+    # the largest c with C(c, s) <= rank
+    c -= 1
+    while Binomial(c, s) > rank:
+      c -= 1
+    rank -= Binomial(c, s)
+    mask |= 1 << c
+  return mask
+
+def Subsets(n, start, end):
+  """Yields the subsets of the ranks start..end-1."""
+  if start >= end:
+    return
+  mask = Unrank(n, start)
+  size = bin(mask).count('1')
+  for rank in xrange(start, end):
+    yield mask
+    # the next subset of the same size (Gosper's hack), or the first one of
+    # the next size after the last one
+    if mask:
+      lowest = mask & -mask
+      ripple = mask + lowest
+      mask = ripple | (((mask ^ ripple) >> 2) // lowest)
+    if not mask or mask >> n:
+      size += 1
+      mask = (1 << size) - 1